@@ -1,16 +1,20 @@
-import sys
+def __getattr__(name):
+    # Looking the version up means importing importlib.metadata, which costs
+    # more than the rest of tfcd's startup, so it's only done when asked for
+    if name != '__version__':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-if sys.version_info[:2] >= (3, 8):
-    # TODO: Import directly (no need for conditional) when `python_requires = >= 3.8`
-    from importlib.metadata import PackageNotFoundError, version  # pragma: no cover
-else:
-    from importlib_metadata import PackageNotFoundError, version  # pragma: no cover
+    import sys
 
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = "terraform-cloud-deployer"
-    __version__ = version(dist_name)
-except PackageNotFoundError:  # pragma: no cover
-    __version__ = "unknown"
-finally:
-    del version, PackageNotFoundError
+    if sys.version_info[:2] >= (3, 8):
+        # TODO: Import directly (no need for conditional) when `python_requires = >= 3.8`
+        from importlib.metadata import PackageNotFoundError, version  # pragma: no cover
+    else:
+        from importlib_metadata import PackageNotFoundError, version  # pragma: no cover
+
+    try:
+        # Change here if project is renamed and does not equal the package name
+        dist_name = "terraform-cloud-deployer"
+        return version(dist_name)
+    except PackageNotFoundError:  # pragma: no cover
+        return "unknown"
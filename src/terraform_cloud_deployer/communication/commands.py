@@ -33,6 +33,6 @@ def send(ctx, slack_channel, slack_token, run_url):
         sys.exit(1)
 
     from terraform_cloud_deployer.communication import communication as communication_class
-    communication_object = communication_class.Communication(run_url)
+    communication_object = communication_class.Communication(run_url, tracer=ctx.obj['tracer'])
 
     communication_object.send_slack_message(slack_channel, slack_token)
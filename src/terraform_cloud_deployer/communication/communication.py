@@ -3,14 +3,31 @@ An unfortunately non-generic class for sending communication about runs. It's sp
 designed for Slack communication at the moment
 """
 
+import json
+import time
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import ConnectionErrorRetryHandler
+
+SLACK_POST_MESSAGE_URL = 'https://slack.com/api/chat.postMessage'
+
+class CountingRetryHandler(ConnectionErrorRetryHandler):
+    """ Slack's default retry handler, keeping count of the retries it makes """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retries = 0
+
+    def prepare_for_next_attempt(self, **kwargs):
+        self.retries += 1
+        super().prepare_for_next_attempt(**kwargs)
 
 class Communication():
     """ Non-generic communication class for sending messages about runs """
 
-    def __init__ (self, run_url):
+    def __init__ (self, run_url, tracer=None):
         self.run_url = run_url
+        self.tracer = tracer
 
     def compose_slack_run_block(self):
         """ Compose a message block for Slack """
@@ -38,13 +55,38 @@ class Communication():
     def send_slack_message(self, slack_channel, slack_token):
         """ Send a message to [slack_channel] """
 
-        client = WebClient(token=slack_token)
+        retry_handler = CountingRetryHandler()
+        client = WebClient(token=slack_token, retry_handlers=[retry_handler])
         run_block = self.compose_slack_run_block()
 
+        started = time.perf_counter()
+        response = None
+        error = None
         try:
             response = client.chat_postMessage(
                 channel=slack_channel,
                 blocks=[run_block]
             )
         except SlackApiError as e:
+            response = e.response
+            error = e.response.get('error')
             print(f"Couldn't send a message to Slack:\n{e}")
+        finally:
+            if self.tracer is not None:
+                self.trace_message(started, response, retry_handler.retries, error)
+
+    def trace_message(self, started, response, retries, error=None):
+        """
+        Record sending a message on the tracer. slack_sdk doesn't expose its
+        connections, so there's no DNS, connect or time to first byte
+        """
+
+        finished = time.perf_counter()
+        response_bytes = None
+        if response is not None:
+            content_length = response.headers.get('content-length') or response.headers.get('Content-Length')
+            response_bytes = int(content_length) if content_length else len(json.dumps(response.data))
+
+        self.tracer.record_request('POST', SLACK_POST_MESSAGE_URL, started, finished,
+                                   status=None if response is None else response.status_code,
+                                   response_bytes=response_bytes, retries=retries, error=error)
@@ -0,0 +1,297 @@
+"""
+Long running tfcd server, and the thin client which forwards to it
+
+'tfcd serve' keeps a process running behind a Unix socket, holding on to
+its HTTP connection pools and lookup caches from one command to the next.
+While it's up, every other tfcd call just sends its arguments, working
+directory and environment over the socket and copies back the output and
+exit code, without importing click, requests or anything else heavy.
+
+The environment holds API tokens, so a client only talks to a socket owned
+by, only open to, and served by the same user. The server runs one command
+at a time; a call which finds it busy with another runs in its own process.
+
+The client side of this module is imported on every tfcd call, so only
+the standard library's lightest modules are imported at the top
+"""
+
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+# How long a client waits for the server to take its command before running it itself
+BUSY_TIMEOUT = 1.0
+
+# How long the server waits for a client to send its command once it's been taken
+REQUEST_TIMEOUT = 10.0
+
+# The only options of the top level command which don't take a value
+TOP_LEVEL_FLAGS = ['--help', '--version']
+
+def socket_path():
+    """
+    Where the server listens: $TFCD_SOCKET, else tfcd.sock in the user's
+    runtime directory, else in a tfcd-<uid> directory only they can use
+    under the temporary directory
+    """
+
+    if os.environ.get('TFCD_SOCKET'):
+        return os.environ['TFCD_SOCKET']
+
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or private_directory(), 'tfcd.sock')
+
+def private_directory():
+    """ Directory for the socket when there's no runtime directory, as anyone can make files in the temporary one """
+
+    return os.path.join(os.environ.get('TMPDIR') or '/tmp', f"tfcd-{os.getuid()}")
+
+def is_private(path):
+    """ True if [path] is ours and nobody else may read or write it. Symlinks never are """
+
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return False
+
+    return not stat.S_ISLNK(path_stat.st_mode) and path_stat.st_uid == os.getuid() and not stat.S_IMODE(path_stat.st_mode) & 0o077
+
+def peer_uid(connection):
+    """ The user ID of the process at the other end of the Unix socket [connection], or None where that can't be told """
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    _, uid, _ = struct.unpack('3i', connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+def run():
+    """ Entry point for the tfcd command: hand over to a running server if there is one, otherwise run here """
+
+    arguments = sys.argv[1:]
+    if subcommand(arguments) != 'serve' and not os.environ.get('TFCD_NO_DAEMON'):
+        exit_code = forward(arguments)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from terraform_cloud_deployer.tfcd import main
+    main(prog_name='tfcd')
+
+def subcommand(arguments):
+    """
+    The subcommand the tfcd [arguments] call for, or None. Worked out without
+    click, so option values (like '-w serve') aren't taken for it
+    """
+
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == '--':
+            return next(arguments, None)
+        if not argument.startswith('-') or argument == '-':
+            return argument
+        # Skip the value, unless there isn't one or it's attached (--option=value, -wvalue)
+        if argument not in TOP_LEVEL_FLAGS and '=' not in argument and (argument.startswith('--') or len(argument) == 2):
+            next(arguments, None)
+
+    return None
+
+# Client
+
+def forward(arguments):
+    """
+    Run the tfcd command [arguments] on the server, copying its output
+    here. Returns its exit code, or None if there's no server (of ours)
+    to talk to, or it's busy
+    """
+
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+
+    # Our environment (tokens and all) only goes to a server run by us
+    if not is_private(path):
+        print(f"tfcd: not using {path}, as it isn't a socket only this user can use", file=sys.stderr)
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        # Left behind by a server that's gone
+        connection.close()
+        return None
+
+    with connection, connection.makefile('r', encoding='utf-8') as replies:
+        if peer_uid(connection) not in (None, os.getuid()):
+            print(f"tfcd: not using {path}, as it's served by another user", file=sys.stderr)
+            return None
+
+        # The server says when it's ready for our command. If it's busy with someone else's, don't wait
+        connection.settimeout(BUSY_TIMEOUT)
+        try:
+            if 'ready' not in json.loads(replies.readline() or '{}'):
+                return None
+        except (OSError, ValueError):
+            return None
+        connection.settimeout(None)
+
+        request = {'argv': arguments, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        for this_line in replies:
+            reply = json.loads(this_line)
+            if 'exit' in reply:
+                return reply['exit']
+            stream = sys.stdout if 'stdout' in reply else sys.stderr
+            stream.write(reply.get('stdout', reply.get('stderr')))
+            stream.flush()
+
+    # The server went away part way through
+    return 1
+
+# Server
+
+# Clients kept alive between commands while serving, by everything that went into making them
+warm_clients = None
+
+def warm_client(key, create):
+    """ Return the client for [key] from earlier commands, or make one with [create] """
+
+    if key not in warm_clients:
+        warm_clients[key] = create()
+
+    return warm_clients[key]
+
+class SocketStream():
+    """ Text stream which sends everything written to it down [connection], tagged as [name] """
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def write(self, text):
+        # click checks whether a stream takes bytes by trying to write some
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        if text:
+            try:
+                self.connection.sendall(json.dumps({self.name: text}).encode('utf-8') + b'\n')
+            except OSError:
+                # The client has gone, but the command should still be allowed to finish
+                pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def serve(path=None, idle_timeout=3600):
+    """
+    Run tfcd commands sent to the Unix socket at [path] one at a time, until
+    nothing has been sent for [idle_timeout] seconds (0 to never stop)
+    """
+
+    global warm_clients
+    warm_clients = {}
+
+    path = path or socket_path()
+    if os.path.dirname(path) == private_directory():
+        try:
+            os.makedirs(private_directory(), mode=0o700, exist_ok=True)
+        except OSError:
+            pass
+        # Someone else could have made it first
+        if not os.path.isdir(private_directory()) or not is_private(private_directory()):
+            sys.exit(f"Not serving on {path}, as {private_directory()} isn't a directory only this user can use")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only this user may talk to the server: commands run with the tokens it's sent
+    previous_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(previous_umask)
+    server.listen()
+    server.settimeout(idle_timeout or None)
+    print(f"Serving tfcd on {path}", file=sys.stderr)
+
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                print(f"Nothing to do for {idle_timeout} seconds, stopping", file=sys.stderr)
+                return
+            with connection:
+                handle(connection)
+    finally:
+        server.close()
+        os.unlink(path)
+        for this_client in warm_clients.values():
+            this_client.close()
+
+def handle(connection):
+    """ Run the command sent over [connection] as if it were run from the client's shell """
+
+    import contextlib
+    import io
+    from terraform_cloud_deployer.tfcd import main
+
+    if peer_uid(connection) not in (None, os.getuid()):
+        return
+
+    try:
+        connection.sendall(json.dumps({'ready': True}).encode('utf-8') + b'\n')
+        connection.settimeout(REQUEST_TIMEOUT)
+        with connection.makefile('r', encoding='utf-8') as requests_io:
+            request_line = requests_io.readline()
+        connection.settimeout(None)
+    except OSError:
+        return
+    # The client gave up waiting and ran the command itself
+    if not request_line:
+        return
+    try:
+        request = json.loads(request_line)
+        argv, cwd, env = request['argv'], request['cwd'], request['env']
+    except (ValueError, TypeError, KeyError):
+        # Not from a tfcd client, or cut short; drop it rather than the server
+        return
+
+    original_directory = os.getcwd()
+    original_environment = dict(os.environ)
+    exit_code = 0
+    try:
+        with contextlib.redirect_stdout(SocketStream(connection, 'stdout')), \
+             contextlib.redirect_stderr(SocketStream(connection, 'stderr')):
+            # There's nobody to answer prompts
+            sys.stdin = io.StringIO('')
+            try:
+                # Errors here (e.g. the client's directory has gone) go back to the client too
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(env)
+                main.main(args=argv, prog_name='tfcd')
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                if isinstance(e.code, str):
+                    print(e.code, file=sys.stderr)
+            except Exception as e:
+                print(f"tfcd serve: {type(e).__name__}: {e}", file=sys.stderr)
+                exit_code = 1
+    finally:
+        sys.stdin = sys.__stdin__
+        os.environ.clear()
+        os.environ.update(original_environment)
+        os.chdir(original_directory)
+
+    try:
+        connection.sendall(json.dumps({'exit': exit_code}).encode('utf-8') + b'\n')
+    except OSError:
+        pass
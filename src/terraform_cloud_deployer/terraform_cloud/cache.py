@@ -0,0 +1,228 @@
+"""
+Local on-disk caches used to avoid repeating Terraform Cloud lookups between
+tfcd invocations
+
+Everything lives under $TFCD_CACHE_DIR, falling back to $XDG_CACHE_HOME/tfcd
+and then ~/.cache/tfcd. Nothing is created there until there's something to
+keep, and if it can't be written to the caches just act as if they're empty
+"""
+
+import json
+import os
+import time
+import logging
+import tempfile
+
+def cache_directory():
+    """ Return the directory caches are kept in, which may not exist yet """
+
+    return os.environ.get('TFCD_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+        'tfcd')
+
+class JSONCache():
+    """ A small JSON document on disk, read lazily and written atomically """
+
+    def __init__(self, file_name):
+        self.path = os.path.join(cache_directory(), file_name)
+        self._data = None
+
+    @property
+    def data(self):
+        """ The cached document, loaded from disk on first use """
+
+        if self._data is None:
+            try:
+                with open(self.path, 'r') as cache_io:
+                    self._data = json.load(cache_io)
+            except (OSError, ValueError):
+                self._data = {}
+
+        return self._data
+
+    def save(self):
+        """ Write the document back to disk, replacing the old copy in one step """
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(file_descriptor, 'w') as cache_io:
+                json.dump(self.data, cache_io)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not write cache file '{self.path}': {e}")
+
+class WorkspaceCache(JSONCache):
+    """
+    Workspace name to ID mapping, per organisation. Entries older than [ttl]
+    seconds are ignored, and a [ttl] of 0 turns the cache off altogether
+    """
+
+    def __init__(self, ttl=86400):
+        super().__init__('workspaces.json')
+        self.ttl = ttl
+
+    def get(self, tfc_organisation, tfc_workspace):
+        """ Return the cached ID of [tfc_workspace], or None if it's unknown or expired """
+
+        if not self.ttl:
+            return None
+
+        entry = self.data.get(tfc_organisation, {}).get(tfc_workspace)
+        if entry is None or time.time() - entry['cached_at'] > self.ttl:
+            return None
+
+        return entry['id']
+
+    def set(self, tfc_organisation, tfc_workspace, workspace_id):
+        """ Remember that [tfc_workspace] in [tfc_organisation] has the ID [workspace_id] """
+
+        if not self.ttl:
+            return
+
+        self.data.setdefault(tfc_organisation, {})[tfc_workspace] = {'id': workspace_id, 'cached_at': time.time()}
+        self.save()
+
+    def invalidate(self, workspace_id):
+        """ Forget any workspace with the ID [workspace_id] """
+
+        if not self.ttl:
+            return
+
+        changed = False
+        for workspaces in self.data.values():
+            for name in [name for name, entry in workspaces.items() if entry['id'] == workspace_id]:
+                logging.debug(f"Dropping '{name}' ({workspace_id}) from the workspace cache")
+                del workspaces[name]
+                changed = True
+
+        if changed:
+            self.save()
+
+class ConfigurationCache(JSONCache):
+    """
+    Which configuration version was uploaded for which content hash, per
+    workspace. Only the most recent [keep] uploads per workspace are remembered
+    """
+
+    def __init__(self, keep=20):
+        super().__init__('configurations.json')
+        self.keep = keep
+
+    def get(self, workspace_id, content_hash):
+        """ Return the ID of the configuration version uploaded with [content_hash], or None """
+
+        return self.data.get(workspace_id, {}).get(content_hash)
+
+    def set(self, workspace_id, content_hash, configuration_id):
+        """ Remember that [configuration_id] was uploaded to [workspace_id] with [content_hash] """
+
+        uploads = self.data.setdefault(workspace_id, {})
+        uploads.pop(content_hash, None)
+        uploads[content_hash] = configuration_id
+
+        # Dicts keep insertion order, so the oldest uploads come first
+        for old_hash in list(uploads)[:-self.keep]:
+            del uploads[old_hash]
+
+        self.save()
+
+    def forget(self, workspace_id, content_hash):
+        """ Drop the record of [content_hash] for [workspace_id] """
+
+        if self.data.get(workspace_id, {}).pop(content_hash, None):
+            self.save()
+
+class StateCache():
+    """
+    Statefile contents by state version ID. State versions never change once
+    they're finalized, so the ID is as good as a content address. The least
+    recently used statefiles are dropped once the cache grows past [max_size]
+    bytes, and a [max_size] of 0 turns the cache off altogether
+    """
+
+    def __init__(self, max_size=1024 * 1024 * 1024, chunk_size=1024 * 1024):
+        self.directory = os.path.join(cache_directory(), 'states')
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    def path(self, state_version_id):
+        """ Where the statefile for [state_version_id] is kept """
+
+        return os.path.join(self.directory, f"{os.path.basename(state_version_id)}.tfstate")
+
+    def get(self, state_version_id):
+        """ Return the chunks of the cached statefile for [state_version_id], or None if it isn't cached """
+
+        if not self.max_size:
+            return None
+
+        path = self.path(state_version_id)
+        try:
+            # The modification time doubles as the last used time for eviction
+            os.utime(path)
+        except OSError:
+            return None
+
+        logging.debug(f"Reading {state_version_id} from the state cache")
+        return self.read_chunks(path)
+
+    def read_chunks(self, path):
+        """ Yield the contents of [path] a chunk at a time """
+
+        with open(path, 'rb') as state_io:
+            for chunk in iter(lambda: state_io.read(self.chunk_size), b''):
+                yield chunk
+
+    def store(self, state_version_id, chunks):
+        """
+        Pass [chunks] straight through, keeping a copy which is added to the
+        cache as [state_version_id] once the last chunk has gone by
+        """
+
+        if not self.max_size:
+            yield from chunks
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix='.partial-')
+        except OSError as e:
+            logging.warning(f"Could not write to the state cache '{self.directory}': {e}")
+            yield from chunks
+            return
+
+        try:
+            with os.fdopen(file_descriptor, 'wb') as state_io:
+                for chunk in chunks:
+                    state_io.write(chunk)
+                    yield chunk
+            os.replace(temporary_path, self.path(state_version_id))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+        try:
+            self.evict()
+        except OSError as e:
+            logging.warning(f"Could not tidy up the state cache '{self.directory}': {e}")
+
+    def evict(self):
+        """ Drop the least recently used statefiles until the cache fits in [max_size] """
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tfstate'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logging.debug(f"Dropping '{path}' from the state cache")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
@@ -0,0 +1,287 @@
+"""
+Shared HTTP client for talking to the Terraform Cloud API
+
+One of these is created by the top level command and handed to the Run,
+Configuration and Workspace classes, so that every call made during a single
+tfcd invocation goes over the same pool of keep-alive connections. With a
+tracer, each call is also timed, down to how long new connections took to
+resolve and connect
+"""
+
+import re
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+
+from terraform_cloud_deployer.terraform_cloud.cache import WorkspaceCache
+from terraform_cloud_deployer.terraform_cloud.rate_limit import TokenBucket, retry_after
+from terraform_cloud_deployer.tracing import endpoint_template
+
+# {'dns': seconds, 'connect': seconds} for the call being traced on this thread, if any
+connection_timings = threading.local()
+
+class Client():
+    """ Pooled, pre-authenticated HTTP session for Terraform Cloud """
+
+    def __init__(self, tfc_api_token, tfc_root_url, pool_size=10, timeout=30, workspace_cache=None, rate_limit=30, max_retries=5,
+                 tracer=None):
+        self.tfc_api_token = tfc_api_token
+        self.tfc_root_url = tfc_root_url
+        self.timeout = timeout
+        self.workspace_cache = workspace_cache or WorkspaceCache()
+        self.rate_limiter = TokenBucket(rate_limit)
+        self.max_retries = max_retries
+        self.tracer = tracer
+
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'})
+
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a [method] request to [url], applying the default timeout if none
+        was given. Calls to the API wait their turn in the rate limiter, and
+        429s are retried after Retry-After up to [max_retries] times before an
+        HTTPError is raised. With a tracer, the call (retries and all) is
+        recorded on it
+        """
+
+        if self.tracer is None:
+            return self.make_request(method, url, **kwargs)
+
+        connection_timings.current = timings = {'retries': 0}
+        started = time.perf_counter()
+        try:
+            response = self.make_request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.trace(method, url, started, timings, e.response, kwargs.get('stream'), error=str(e))
+            raise
+        finally:
+            connection_timings.current = None
+
+        if kwargs.get('stream'):
+            # A streamed call isn't over until its body has been read, or given up on
+            response.raw = TracedBody(response.raw,
+                                      lambda error: self.trace(method, url, started, timings, response, True, error=error))
+        else:
+            self.trace(method, url, started, timings, response)
+
+        return response
+
+    def trace(self, method, url, started, timings, response=None, stream=False, error=None):
+        """ Record the call to [url] which began at [started] on the tracer, as it stands now """
+
+        request_bytes = response_bytes = ttfb = None
+        if response is not None:
+            request_bytes = content_length(response.request.headers)
+            # Only what's actually been read of a streamed body, which is nothing if it's not been wrapped yet
+            response_bytes = getattr(response.raw, 'bytes_read', None) if stream else len(response.content)
+            # elapsed runs from sending the request to having the headers, so includes setting up a new connection
+            ttfb = max(response.elapsed.total_seconds() - timings.get('setup', 0), 0)
+
+        self.tracer.record_request(method, endpoint_template(url, self.tfc_root_url), started, time.perf_counter(),
+                                   status=None if response is None else response.status_code,
+                                   request_bytes=request_bytes, response_bytes=response_bytes,
+                                   dns=timings.get('dns'), connect=timings.get('connect'), ttfb=ttfb,
+                                   retries=timings['retries'], error=error)
+
+    def make_request(self, method, url, **kwargs):
+        """ request(), without the tracing """
+
+        kwargs.setdefault('timeout', self.timeout)
+        is_api_call = url.startswith(self.tfc_root_url)
+
+        # Only set while the call is being traced
+        timings = getattr(connection_timings, 'current', None)
+
+        retries = 0
+        while True:
+            if is_api_call:
+                self.rate_limiter.acquire()
+
+            if timings is not None:
+                setup_before = timings.get('dns', 0) + timings.get('connect', 0)
+            response = self.session.request(method, url, **kwargs)
+            if timings is not None:
+                # How long this attempt spent on DNS and connecting, if it needed a new connection
+                timings['setup'] = timings.get('dns', 0) + timings.get('connect', 0) - setup_before
+            if is_api_call:
+                self.rate_limiter.update(response.headers)
+
+            if response.status_code != 429:
+                break
+
+            if retries >= self.max_retries or not rewind(kwargs.get('data')):
+                raise requests.exceptions.HTTPError(f"Still rate limited after {retries} retries: {method} {url}", response=response)
+
+            retries += 1
+            if timings is not None:
+                timings['retries'] = retries
+            response.close()
+            self.rate_limiter.block_for(retry_after(response))
+
+        # A 404 on anything under a workspace ID means the ID we were given
+        # (quite possibly from the cache) no longer points at a workspace
+        if response.status_code == 404:
+            workspace_id_matches = re.search('/workspaces/(ws-[A-Za-z0-9]+)', url)
+            if workspace_id_matches:
+                self.workspace_cache.invalidate(workspace_id_matches.group(1))
+
+        return response
+
+    def get(self, url, **kwargs):
+        """ GET [url] """
+
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """ POST to [url] """
+
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        """ PUT to [url] """
+
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        """ PATCH [url] """
+
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self):
+        """ Close all pooled connections """
+
+        self.session.close()
+
+class TracedBody():
+    """
+    Stands in for the urllib3 body of a streamed response, counting the
+    bytes read from it and calling [on_finished] (with any error) once it has
+    been read to the end or closed
+    """
+
+    def __init__(self, raw, on_finished):
+        self.raw = raw
+        self.on_finished = on_finished
+        self.finished = False
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def stream(self, *args, **kwargs):
+        try:
+            for chunk in self.raw.stream(*args, **kwargs):
+                self.bytes_read += len(chunk)
+                yield chunk
+        except Exception as e:
+            self.finish(str(e))
+            raise
+        self.finish()
+
+    def read(self, *args, **kwargs):
+        data = self.raw.read(*args, **kwargs)
+        self.bytes_read += len(data)
+        # Read to the end, either all at once or by coming up empty
+        if not data or (args[0] if args else kwargs.get('amt')) is None:
+            self.finish()
+        return data
+
+    def close(self):
+        self.raw.close()
+        self.finish()
+
+    def finish(self, error=None):
+        if not self.finished:
+            self.finished = True
+            self.on_finished(error)
+
+class TimedConnectionMixin():
+    """
+    Times looking up the host and connecting (with any TLS handshake) for
+    each new connection made for a traced call. The lookup is done here,
+    rather than inside urllib3, so that it can be timed on its own
+    """
+
+    def _new_conn(self):
+        timings = getattr(connection_timings, 'current', None)
+        if timings is None:
+            return super()._new_conn()
+
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            self._dns_host = socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM)[0][4][0]
+        except OSError:
+            # Left for urllib3 to fail on, with its usual error
+            pass
+        timings['dns'] = timings.get('dns', 0) + time.perf_counter() - started
+
+        try:
+            return super()._new_conn()
+        except Exception:
+            if self._dns_host == host:
+                raise
+            # Let urllib3 try the host's other addresses, as it would untraced
+            self._dns_host = host
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+    def connect(self):
+        timings = getattr(connection_timings, 'current', None)
+        if timings is None:
+            return super().connect()
+
+        dns = timings.get('dns', 0)
+        started = time.perf_counter()
+        super().connect()
+        timings['connect'] = timings.get('connect', 0) + time.perf_counter() - started - (timings.get('dns', 0) - dns)
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter whose connections time themselves when a call is being traced """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+# Functions
+
+def rewind(data):
+    """ Get a request body ready to be sent again. False if that can't be done (e.g. a generator) """
+
+    if data is None or isinstance(data, (str, bytes, dict)):
+        return True
+
+    if hasattr(data, 'seek'):
+        data.seek(0)
+        return True
+
+    return False
+
+def content_length(headers):
+    """ The Content-Length in [headers], or None for a body of unknown length (e.g. chunked) """
+
+    length = headers.get('Content-Length')
+
+    return int(length) if length else None
@@ -3,6 +3,8 @@ Commands for handling configuration versions and runs in Terraform Cloud
 """
 
 import click
+import json
+import os
 import re
 from pprint import pprint
 import sys
@@ -21,13 +23,12 @@ def list_configurations(ctx, tfc_workspace):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import configuration as configuration_class
-    configuration_object = configuration_class.Configuration(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    configuration_object = configuration_class.Configuration(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
     configuration_object.list()
 
@@ -40,55 +41,81 @@ def show(ctx, tfc_workspace, configuration_id):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import configuration as configuration_class
-    configuration_object = configuration_class.Configuration(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    configuration_object = configuration_class.Configuration(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
     configuration_object.show(configuration_id)
 
 @configuration.command()
 @click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
+@click.option('--chunk-size', type=click.IntRange(1024), default=1024 * 1024, show_default=True, help='Bytes to read and write at a time')
+@click.option('--extract-to', '-x', help='Unpack into this directory as it downloads, instead of saving the archive')
 @click.argument("configuration-id")
 @click.pass_context
-def download(ctx, tfc_workspace, configuration_id):
-    """ Download the configuration package for [configuration-id] """
+def download(ctx, tfc_workspace, chunk_size, extract_to, configuration_id):
+    """ Download the configuration package for [configuration-id], or unpack it with --extract-to """
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import configuration as configuration_class
-    configuration_object = configuration_class.Configuration(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    configuration_object = configuration_class.Configuration(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
-    configuration_object.download(configuration_id)
+    print(configuration_object.download(configuration_id, chunk_size, extract_to))
 
 @configuration.command()
 @click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
 @click.option('--terraform-directory', '-t', help='Where the Terraform files can be found', default='.')
 @click.option('--code-directory', '-c', help='Where the application code can be found', required=True)
+@click.option('--force-upload', is_flag=True, default=False, help='Upload even if these exact files were uploaded before')
+@click.option('--stream-upload', is_flag=True, default=False, help='Compress straight into the upload instead of via a temporary file')
+@click.option('--compression-level', type=click.IntRange(1, 9), default=9, show_default=True, help='gzip compression level')
+@click.option('--compression-workers', type=click.IntRange(1), default=os.cpu_count() or 1, show_default=True, help='How many cores to compress on')
+@click.option('--exclude', '-e', help='.terraformignore style pattern to leave out of the upload, on top of .terraformignore itself', multiple=True)
+@click.option('--dry-run', is_flag=True, default=False, help="Don't upload, just report what would be included and the largest files and directories")
+@click.option('--auto-queue-runs', is_flag=True, default=False, help='Have Terraform Cloud queue a run once the upload is processed, and print its ID')
+@click.option('--speculative', is_flag=True, default=False, help='Make this a plan-only configuration, whose runs can never be applied')
 @click.pass_context
-def create(ctx, tfc_workspace, terraform_directory, code_directory):
+def create(ctx, tfc_workspace, terraform_directory, code_directory, force_upload, stream_upload, compression_level, compression_workers, exclude, dry_run,
+           auto_queue_runs, speculative):
     """ Create and upload a Terraform Cloud configuration object """
 
+    from terraform_cloud_deployer.terraform_cloud import configuration as configuration_class
+    if dry_run:
+        configuration_class.report_configuration(configuration_class.configuration_paths(terraform_directory, code_directory, exclude))
+        return
+
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
-    from terraform_cloud_deployer.terraform_cloud import configuration as configuration_class
-    configuration_object = configuration_class.Configuration(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    configuration_object = configuration_class.Configuration(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
+
+    configuration_id = configuration_object.create(terraform_directory, code_directory, force_upload, stream_upload,
+                                                compression_level, compression_workers, exclude, auto_queue_runs, speculative)
+    if not auto_queue_runs:
+        print(configuration_id)
+        return
 
-    configuration_id = configuration_object.create(terraform_directory, code_directory)
-    print(configuration_id)
+    run_id = configuration_object.find_run(configuration_id)
+    if run_id is None:
+        print(f"Uploaded {configuration_id}, but no run was queued for it in time")
+        sys.exit(1)
+
+    print(json.dumps({
+      "run_url": f"https://app.terraform.io/app/{tfc_organisation}/workspaces/{tfc_workspace}/runs/{run_id}",
+      "run_id": run_id,
+      "configuration_id": configuration_id
+    }))
 
 @click.group
 @click.pass_context
@@ -100,19 +127,20 @@ def run(ctx): # pylint: disable=unused-argument
 @click.option('--tfc-workspace', help='Workspace name to operate on', required=False)
 @click.option('--configuration-id', '-c', help='Configuration ID to queue the run for', required=True)
 @click.option('--wait', '-w', is_flag=True, help='Whether to wait for the output of the plan (and output it)', default=False)
+@click.option('--logs', is_flag=True, help='Copy the plan log to stderr as it is written while waiting', default=False)
 @click.pass_context
-def queue(ctx, tfc_workspace, configuration_id, wait):
+def queue(ctx, tfc_workspace, configuration_id, wait, logs):
     """ Add <configuration_id> (configuration version) to the run queue """
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import run as run_class
-    run_object = run_class.Run(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'],
+                               log_output=sys.stderr if logs else None)
 
     run_id = run_object.queue(configuration_id, wait)
     print(run_id)
@@ -126,17 +154,15 @@ def show_plan(ctx, tfc_workspace, plan_id):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import run as run_class
-    run_object = run_class.Run(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
-    output = run_object.get_plan(plan_id)
-    from pprint import pprint
-    pprint(output)
+    for address, change in run_object.iter_plan(plan_id):
+        pprint({address: change})
 
 @run.command()
 @click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
@@ -147,13 +173,12 @@ def apply(ctx, tfc_workspace, run_id, comment):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import run as run_class
-    run_object = run_class.Run(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
     # output = run_object.apply(run_id, comment)
     # print(output)
@@ -170,13 +195,12 @@ def cancel(ctx, tfc_workspace, run_id, auto_approve, force, comment):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import run as run_class
-    run_object = run_class.Run(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
 
     run_object.cancel(run_id, auto_approve=auto_approve, force=force, comment=comment)
 
@@ -184,21 +208,100 @@ def cancel(ctx, tfc_workspace, run_id, auto_approve, force, comment):
 @click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
 @click.option('--full-output', '-o', help='Whether or not to print the full JSON output', is_flag=True, default=False)
 @click.option('--filters', '-f', help='[status|user|page|operation|source|search]=values. Invalid filters are ignored', multiple=True)
+@click.option('--limit', '-l', type=int, help='Stop after printing this many runs')
+@click.option('--stop-on', '-s', help='[attribute]=value. Stop after the page containing a matching run, e.g. status=applied', multiple=True)
 @click.pass_context
-def list_runs(ctx, tfc_workspace, full_output, filters):
+def list_runs(ctx, tfc_workspace, full_output, filters, limit, stop_on):
     """ List runs in <workspace_id> """
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
+    tfc_organisation = ctx.obj['tfc_organisation']
+    tfc_workspace = ctx.obj['tfc_workspace']
+
+    from terraform_cloud_deployer.terraform_cloud import run as run_class
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
+
+    stop_on = dict(condition.split('=', 1) for condition in stop_on if '=' in condition)
+    run_object.list(full_output, format_filters(filters), limit=limit, stop_on=stop_on)
+
+@run.command()
+@click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
+@click.option('--apply', 'phase', flag_value='apply', help="Follow the apply's log rather than the plan's")
+@click.option('--plan', 'phase', flag_value='plan', default=True, help="Follow the plan's log (the default)")
+@click.argument('run-id')
+@click.pass_context
+def logs(ctx, tfc_workspace, phase, run_id):
+    """ Print the plan (or apply) log of <run-id> to stderr as it is written """
+
+    ctx = workspace_deprecation_hack(ctx, tfc_workspace)
+
+    tfc_client = ctx.obj['tfc_client']
+    tfc_organisation = ctx.obj['tfc_organisation']
+    tfc_workspace = ctx.obj['tfc_workspace']
+
+    from terraform_cloud_deployer.terraform_cloud import run as run_class
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
+
+    status = run_object.tail_log(run_id, phase)
+    if status is None:
+        print(f"Gave up waiting on the {phase} log of {run_id}")
+        sys.exit(1)
+    if status != 'finished':
+        sys.exit(1)
+
+@run.command()
+@click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
+@click.option('--listen', help='host:port to receive Terraform Cloud run notifications on, instead of polling')
+@click.option('--public-url', help='URL Terraform Cloud should send notifications to, if not http://<listen>/')
+@click.argument('run-id')
+@click.pass_context
+def wait(ctx, tfc_workspace, listen, public_url, run_id):
+    """ Wait until <run-id> has finished or is waiting on someone, and print its status """
+
+    ctx = workspace_deprecation_hack(ctx, tfc_workspace)
+
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
     tfc_workspace = ctx.obj['tfc_workspace']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import run as run_class
-    run_object = run_class.Run(tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace)
+    from terraform_cloud_deployer.terraform_cloud.watcher import FAILED_STATUSES
+    run_object = run_class.Run(tfc_client, tfc_organisation, tfc_workspace, poller=ctx.obj['tfc_poller'])
+
+    status = run_object.wait(run_id, listen, public_url)
+    if status is None:
+        print(f"Gave up waiting on {run_id}")
+        sys.exit(1)
+
+    print(status)
+    if status in FAILED_STATUSES:
+        sys.exit(1)
+
+@run.command()
+@click.argument('run-ids', nargs=-1, required=True)
+@click.pass_context
+def watch(ctx, run_ids):
+    """ Follow <run-ids> (in any workspaces) until they've all finished or are waiting on someone """
 
-    run_object.list(full_output, format_filters(filters))
+    tfc_client = ctx.obj['tfc_client']
+
+    from terraform_cloud_deployer.terraform_cloud.watcher import Watcher, FAILED_STATUSES
+    watcher = Watcher(tfc_client, poller=ctx.obj['tfc_poller'])
+    for run_id in run_ids:
+        watcher.add(run_id)
+
+    final_statuses = {}
+    for run_id, previous_status, status in watcher.watch():
+        print(f"{run_id}: {previous_status or 'watching'} -> {status}")
+        final_statuses[run_id] = status
+
+    if watcher.pending:
+        print(f"Gave up waiting on: {', '.join(run_id for runs in watcher.pending.values() for run_id in runs)}")
+        sys.exit(1)
+    if any(status in FAILED_STATUSES for status in final_statuses.values()):
+        sys.exit(1)
 
 @click.group
 @click.pass_context
@@ -208,17 +311,17 @@ def workspace(ctx): # pylint: disable=unused-argument
 
 @workspace.command()
 @click.pass_context
-def list_workspaces(ctx):
+@click.option('--concurrency', '-c', default=4, show_default=True, help='How many pages of workspaces to fetch at once')
+def list_workspaces(ctx, concurrency):
     """ List the most recent statefiles available """
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
-    tfc_root_url = ctx.obj['tfc_root_url']
 
     from terraform_cloud_deployer.terraform_cloud import workspace as workspace_class
-    workspace_object = workspace_class.Workspace(tfc_api_token, tfc_root_url, tfc_organisation)
+    workspace_object = workspace_class.Workspace(tfc_client, tfc_organisation)
 
-    workspaces = workspace_object.list_workspaces()
+    workspaces = workspace_object.list_workspaces(concurrency)
     pprint(workspaces)
 
 @workspace.command()
@@ -230,13 +333,12 @@ def list_states(ctx, tfc_workspace, version):
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
-    tfc_root_url = ctx.obj['tfc_root_url']
     tfc_workspace = ctx.obj['tfc_workspace']
 
     from terraform_cloud_deployer.terraform_cloud import workspace as workspace_class
-    workspace_object = workspace_class.Workspace(tfc_api_token, tfc_root_url, tfc_organisation)
+    workspace_object = workspace_class.Workspace(tfc_client, tfc_organisation)
 
     state_files = workspace_object.list_states(tfc_workspace, version)
     pprint(state_files)
@@ -245,20 +347,59 @@ def list_states(ctx, tfc_workspace, version):
 @click.pass_context
 @click.option('--tfc-workspace', '-w', help='Workspace name to operate on', required=False)
 @click.option('--version', '-v', help='Run version to fetch state for')
-def get_state(ctx, tfc_workspace, version):
+@click.option('--output', '-o', help='Where to write the statefile', default=None)
+@click.option('--pretty', is_flag=True, default=False, help='Re-indent the statefile as it is written')
+@click.option('--gzip', 'compress', is_flag=True, default=False, help='Gzip the statefile as it is written')
+def get_state(ctx, tfc_workspace, version, output, pretty, compress):
     """ Fetch the latest (by default) statefile for <tfc_workspace> """
 
     ctx = workspace_deprecation_hack(ctx, tfc_workspace)
 
-    tfc_api_token = ctx.obj['tfc_api_token']
+    tfc_client = ctx.obj['tfc_client']
     tfc_organisation = ctx.obj['tfc_organisation']
-    tfc_root_url = ctx.obj['tfc_root_url']
     tfc_workspace = ctx.obj['tfc_workspace']
 
     from terraform_cloud_deployer.terraform_cloud import workspace as workspace_class
-    workspace_object = workspace_class.Workspace(tfc_api_token, tfc_root_url, tfc_organisation)
+    workspace_object = workspace_class.Workspace(tfc_client, tfc_organisation, state_cache=ctx.obj['tfc_state_cache'])
+
+    if output is None:
+        output = 'downloaded-terraform.tfstate.gz' if compress else 'downloaded-terraform.tfstate'
+
+    workspace_object.get_state(tfc_workspace, version, output=output, pretty=pretty, compress=compress)
+
+@workspace.command()
+@click.pass_context
+@click.option('--output-directory', '-d', default='state-export', show_default=True, help='Directory to save statefiles and the manifest in')
+@click.option('--pattern', '-p', default='*', show_default=True, help='Only export workspaces whose names match this glob')
+@click.option('--concurrency', '-c', default=4, show_default=True, help='How many statefiles to download at once')
+def export_states(ctx, output_directory, pattern, concurrency):
+    """ Save the current statefile of every workspace (or those matching --pattern), with a checksum manifest """
+
+    tfc_client = ctx.obj['tfc_client']
+    tfc_organisation = ctx.obj['tfc_organisation']
+
+    from terraform_cloud_deployer.terraform_cloud import workspace as workspace_class
+    workspace_object = workspace_class.Workspace(tfc_client, tfc_organisation)
+
+    os.makedirs(output_directory, exist_ok=True)
+    entries = workspace_object.export_states(output_directory, pattern, concurrency)
+    if any(this_entry['status'] == 'failed' for this_entry in entries):
+        sys.exit(1)
+
+@workspace.command()
+@click.pass_context
+@click.argument('old-version')
+@click.argument('new-version')
+def diff_states(ctx, old_version, new_version):
+    """ Show the resource instances added, removed or changed between state versions <old-version> and <new-version> """
+
+    tfc_client = ctx.obj['tfc_client']
+    tfc_organisation = ctx.obj['tfc_organisation']
+
+    from terraform_cloud_deployer.terraform_cloud import workspace as workspace_class
+    workspace_object = workspace_class.Workspace(tfc_client, tfc_organisation, state_cache=ctx.obj['tfc_state_cache'])
 
-    state_file = workspace_object.get_state(tfc_workspace, version)
+    workspace_object.diff_states(old_version, new_version)
 
 # Helper functions
 
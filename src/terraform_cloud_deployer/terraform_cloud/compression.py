@@ -0,0 +1,70 @@
+"""
+Multi-core gzip compression for configuration archives
+
+The stream is cut into blocks which are compressed side by side on a thread
+pool (zlib lets go of the GIL while it works) and written out in order as
+separate gzip members. Concatenated gzip members are a valid gzip file, which
+gunzip, Python's tarfile and Terraform Cloud all read as one stream
+"""
+
+import collections
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+class ParallelGzipWriter():
+    """ Write-only file object that gzips into [fileobj] using [workers] threads """
+
+    def __init__(self, fileobj, compression_level=9, workers=4, block_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.max_pending = workers * 2
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        """ Queue [data] for compression, handing off any full blocks """
+
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def submit(self, block):
+        """ Start compressing [block], first writing out finished blocks if too many are in flight """
+
+        # mtime=0 keeps the output the same for the same input
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compression_level, mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        """ Nothing to do until close(); blocks are written as they finish """
+
+    def close(self):
+        """ Compress whatever is left, write everything out in order, and flush [fileobj] """
+
+        if self.closed:
+            return
+
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+        self.executor.shutdown()
+        self.fileobj.flush()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -4,48 +4,62 @@ CLI methods for Terraform Cloud configuration run handling
 https://developer.hashicorp.com/terraform/cloud-docs/api-docs/configuration-versions
 """
 
-import tarfile
+import requests
+import json
+import gzip
 import glob
+import collections
+import os
+import hashlib
 import datetime
-import requests
-import time
+import tempfile
+import threading
 import sys
 import logging
 
+from terraform_cloud_deployer.terraform_cloud.cache import ConfigurationCache
+from terraform_cloud_deployer.terraform_cloud.compression import ParallelGzipWriter
+from terraform_cloud_deployer.terraform_cloud.json_backend import decode
+from terraform_cloud_deployer.terraform_cloud.ignore import load_rules
+from terraform_cloud_deployer.terraform_cloud.polling import Poller
+from terraform_cloud_deployer.terraform_cloud.transfer import DEFAULT_CHUNK_SIZE, ResumableDownload
+from terraform_cloud_deployer.terraform_cloud.workspace import Workspace
+
+# Files are hashed, and archives streamed to the upload, in pieces of these sizes
+HASH_BLOCK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
 class Configuration():
     """ Methods for creating and interacting with Terraform Cloud configuration versions """
 
-    def __init__(self, tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace):
-        self.tfc_api_token = tfc_api_token
-        self.tfc_root_url = tfc_root_url
+    def __init__(self, tfc_client, tfc_organisation, tfc_workspace, poller=None):
+        self.tfc_client = tfc_client
+        self.poller = poller or Poller()
+        self.tfc_root_url = tfc_client.tfc_root_url
 
-        self.headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
-        try:
-            workspace_info = requests.get(f"{self.tfc_root_url}/organizations/{tfc_organisation}/workspaces/{tfc_workspace}", headers=self.headers)
-            workspace_info.raise_for_status()
-            self.workspace_id = workspace_info.json().get('data').get('id')
-        except (requests.exceptions.HTTPError, AttributeError) as e:
-            print(f"Failed to get information for workspace '{tfc_workspace}'")
-            logging.error(e)
-            print("Check supplied token and workspace")
-            sys.exit(1)
+        self.workspace_id = Workspace(tfc_client, tfc_organisation).get_workspace_id(tfc_workspace)
+        self.configuration_cache = ConfigurationCache()
 
     def show(self, configuration_id):
         """ Print and return information about [configuration_id] """
 
-        cv_full = requests.get(f"{self.tfc_root_url}/configuration-versions/{configuration_id}",
-                               headers=self.headers)
+        cv_full = self.get_configuration_info(configuration_id)
 
         from pprint import pprint
-        pprint(cv_full.json())
+        pprint(decode(cv_full))
         return cv_full
 
     def list(self):
         """ List and return configuration IDs for this workspace """
 
-        response = requests.get(f"{self.tfc_root_url}/workspaces/{self.workspace_id}/configuration-versions",
-                               headers=self.headers).json()
-        cvs = response['data']
+        try:
+            response = self.tfc_client.get(f"{self.tfc_root_url}/workspaces/{self.workspace_id}/configuration-versions")
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error listing configuration versions:\n{e}")
+            sys.exit(1)
+
+        cvs = decode(response)['data']
 
         cv_list = []
         for this_cv in cvs:
@@ -54,80 +68,363 @@ class Configuration():
         print(cv_list)
         return cv_list
 
-    def download(self, configuration_id):
-        """ Download the configuration file of [configuration_id] """
+    def download(self, configuration_id, chunk_size=DEFAULT_CHUNK_SIZE, extract_to=None):
+        """
+        Download the configuration file of [configuration_id], in [chunk_size]
+        pieces. A download that was interrupted, even in an earlier tfcd
+        run, carries on from where it stopped.
+
+        With [extract_to], the archive is unpacked into that directory as it
+        arrives instead of being saved
+        """
 
-        local_filename = f"{configuration_id}.tar.gz"
         cv_download_url = f"{self.tfc_root_url}/configuration-versions/{configuration_id}/download"
-        with requests.get(cv_download_url, stream=True, headers=self.headers) as r:
-            r.raise_for_status()
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    # If you have chunk encoded response uncomment if
-                    # and set chunk_size parameter to None.
-                    # if chunk:
-                    f.write(chunk)
-        return local_filename
 
-    def create(self, terraform_directory, code_directory):
-        """ Create and upload a configuration version from [terraform_directory], [code_directory] """
+        if extract_to:
+            import tarfile
+            download = ResumableDownload(self.tfc_client, cv_download_url, chunk_size=chunk_size)
+            with tarfile.open(fileobj=download, mode="r|gz") as tar_file:
+                # Only the 'data' filter's safety checks where this Python has them
+                extract_options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+                tar_file.extractall(extract_to, **extract_options)
+            return extract_to
+
+        local_filename = f"{configuration_id}.tar.gz"
+        partial_filename = f"{local_filename}.part"
+        offset = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+        if offset:
+            logging.info(f"Resuming the download of {configuration_id} from byte {offset}")
 
-        data_file = package_configuration(terraform_directory, code_directory)
-        configuration_version = self.create_configuration()
-        self.upload_configuration(configuration_version, data_file.name)
+        download = ResumableDownload(self.tfc_client, cv_download_url, offset=offset, chunk_size=chunk_size)
+        with open(partial_filename, 'ab') as f:
+            for chunk in download.iter_chunks():
+                f.write(chunk)
+
+        os.replace(partial_filename, local_filename)
+        return local_filename
+
+    def create(self, terraform_directory, code_directory, force_upload=False, stream_upload=False,
+               compression_level=9, compression_workers=1, excludes=(), auto_queue_runs=False, speculative=False):
+        """
+        Create and upload a configuration version from [terraform_directory], [code_directory].
+
+        If exactly the same files were already uploaded to this workspace from
+        this machine, and that configuration version is still usable, its ID
+        is returned instead and nothing is packaged or uploaded. [force_upload]
+        skips that check.
+
+        With [stream_upload], the archive is compressed straight into the
+        upload request rather than into a temporary file first. Compression
+        is spread over [compression_workers] cores. [excludes] are extra
+        .terraformignore style patterns.
+
+        With [auto_queue_runs], Terraform Cloud queues a run as soon as the
+        upload is processed, a plan-only one if [speculative]. That needs a
+        fresh upload, so no earlier configuration version is reused
+        """
+
+        paths = configuration_paths(terraform_directory, code_directory, excludes)
+        content_hash = hash_configuration(paths)
+        # A speculative configuration version can never be applied, so it mustn't stand in for a normal one
+        if speculative:
+            content_hash = f"{content_hash}:speculative"
+
+        if not force_upload and not auto_queue_runs:
+            configuration_id = self.find_uploaded_configuration(content_hash)
+            if configuration_id:
+                logging.info(f"These files were already uploaded as {configuration_id}, reusing it")
+                return configuration_id
+
+        if stream_upload:
+            configuration_version = self.create_configuration(auto_queue_runs, speculative)
+            self.upload_configuration(configuration_version, stream_configuration(paths,
+                                                                                  compression_level=compression_level,
+                                                                                  compression_workers=compression_workers))
+        else:
+            archive_path = package_configuration(terraform_directory, code_directory, paths,
+                                                 compression_level=compression_level,
+                                                 compression_workers=compression_workers)
+            try:
+                configuration_version = self.create_configuration(auto_queue_runs, speculative)
+                with open(archive_path, 'rb') as data:
+                    self.upload_configuration(configuration_version, data)
+            finally:
+                os.remove(archive_path)
+        self.configuration_cache.set(self.workspace_id, content_hash, configuration_version.get('configuration_id'))
 
         return configuration_version.get('configuration_id')
 
-    def create_configuration(self):
+    def find_uploaded_configuration(self, content_hash):
+        """ Return the ID of a still usable configuration version uploaded with [content_hash], or None """
+
+        configuration_id = self.configuration_cache.get(self.workspace_id, content_hash)
+        if not configuration_id:
+            return None
+
+        configuration_info = self.get_configuration_info(configuration_id)
+        if configuration_info.status_code == 200 and decode(configuration_info).get('data').get('attributes').get('status') == 'uploaded':
+            return configuration_id
+
+        # Archived, errored or gone altogether
+        self.configuration_cache.forget(self.workspace_id, content_hash)
+        return None
+
+    def create_configuration(self, auto_queue_runs=False, speculative=False):
         """ Create new configuration version, return {configuration_id, upload_url} for use """
 
-        response = requests.post(f"{self.tfc_root_url}/workspaces/{self.workspace_id}/configuration-versions",
-                                 headers=self.headers,
-                                 data='{"data":{"type":"configuration-versions", "attributes":{"auto-queue-runs": false}}}')
+        configuration_data = json.dumps({
+          "data": {
+            "type": "configuration-versions",
+            "attributes": {
+              "auto-queue-runs": auto_queue_runs,
+              "speculative": speculative
+            }
+          }
+        })
 
-        configuration_id = response.json().get('data').get('id')
-        upload_url = response.json().get('data').get('attributes').get('upload-url')
+        try:
+            response = self.tfc_client.post(f"{self.tfc_root_url}/workspaces/{self.workspace_id}/configuration-versions",
+                                            data=configuration_data)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error creating a configuration version:\n{e}")
+            sys.exit(1)
+
+        configuration_data = decode(response).get('data')
+        configuration_id = configuration_data.get('id')
+        upload_url = configuration_data.get('attributes').get('upload-url')
 
         return {'configuration_id': configuration_id, 'upload_url': upload_url}
 
-    def upload_configuration(self, configuration_version, data_file):
-        """ Upload data (Terraform code) to [configuration_version] """
+    def upload_configuration(self, configuration_version, data):
+        """
+        Upload [data] (Terraform code) to [configuration_version]. [data] is an
+        open file, or an iterable of chunks to be sent with chunked encoding
+        """
+
+        try:
+            response = self.tfc_client.put(configuration_version.get('upload_url'), headers={'Content-Type': "application/octet-stream"}, data=data)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Could not upload configuration version {configuration_version.get('configuration_id')}:\n{e}")
+            sys.exit(1)
 
-        this_file = open(data_file, 'rb')
+        for _ in self.poller.attempts():
+            status = decode(self.get_configuration_info(configuration_version.get('configuration_id'))).get('data').get('attributes').get('status')
+            if status == 'uploaded':
+                return
 
-        these_headers = self.headers
-        these_headers['Content-Type'] = "application/octet-stream"
-        requests.put(configuration_version.get('upload_url'), headers=these_headers, data=this_file)
+            if status == 'errored':
+                print(f"Terraform Cloud could not process configuration version {configuration_version.get('configuration_id')}")
+                sys.exit(1)
 
-        while self.get_configuration_info(configuration_version.get('configuration_id')).json().get('data').get('attributes').get('status') != 'uploaded':
             logging.info("Configuration version is not ready yet")
-            time.sleep(2)
+
+        print(f"Timed out waiting for configuration version {configuration_version.get('configuration_id')} to finish uploading")
+        sys.exit(1)
+
+    def find_run(self, configuration_id):
+        """
+        Return the ID of the run Terraform Cloud queued for [configuration_id]
+        by itself (auto-queue-runs), waiting for it to turn up. None if it
+        doesn't before the poller's deadline
+        """
+
+        for _ in self.poller.attempts():
+            try:
+                response = self.tfc_client.get(f"{self.tfc_root_url}/workspaces/{self.workspace_id}/runs",
+                                               params={'page[size]': 20, 'fields[runs]': 'configuration-version'})
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                print(f"Error looking for the run queued for {configuration_id}:\n{e}")
+                sys.exit(1)
+
+            for this_run in decode(response).get('data', []):
+                configuration_version = this_run.get('relationships', {}).get('configuration-version', {}).get('data') or {}
+                if configuration_version.get('id') == configuration_id:
+                    return this_run['id']
+
+            logging.info(f"No run has been queued for {configuration_id} yet")
+
+        return None
 
     def get_configuration_info(self, configuration_id):
         """ Fetch and return information on [configuration_id] """
 
-        configuration_info = requests.get(
-                                  f"{self.tfc_root_url}/configuration-versions/{configuration_id}",
-                                  headers=self.headers)
+        try:
+            configuration_info = self.tfc_client.get(
+                                      f"{self.tfc_root_url}/configuration-versions/{configuration_id}")
+        except requests.exceptions.HTTPError as e:
+            print(f"Error getting configuration version {configuration_id}:\n{e}")
+            sys.exit(1)
 
         return configuration_info
 
 # Functions
 
-def package_configuration(terraform_directory, code_directory):
-    """ Tar and Gzip the TFC configuration from [terraform_directory] and [code_directory] """
+def configuration_paths(terraform_directory, code_directory, excludes=()):
+    """
+    Return the paths that make up the configuration, in a stable order:
+    everything under [code_directory] (directories included), then the
+    *.tf files in [terraform_directory].
 
-    this_date = datetime.datetime.now().isoformat()
-    terraform_files = glob.glob(f"{terraform_directory}/*.tf")
+    Anything matched by .terraformignore in [terraform_directory], or by one
+    of the gitignore style patterns in [excludes], is left out. Excluded
+    directories aren't walked at all unless a negated pattern could bring
+    back something inside them
+    """
 
-    try:
-        with tarfile.open(f"{this_date}.tar.gz", "w:gz") as tar_file:
-            tar_file.add(code_directory)
-
-            for name in terraform_files:
-                tar_file.add(name)
-    except FileNotFoundError:
+    if not os.path.lexists(code_directory):
         logging.error(f"File/directory {code_directory} does not exist")
         sys.exit(1)
 
-    return tar_file
+    ignore_rules = load_rules(terraform_directory, excludes)
+
+    def is_ignored(path, is_directory, parent_ignored):
+        verdict = ignore_rules.match(os.path.relpath(path, terraform_directory), is_directory)
+        return parent_ignored if verdict is None else verdict
+
+    ignored_directories = {code_directory: is_ignored(code_directory, os.path.isdir(code_directory), False)}
+    paths = [] if ignored_directories[code_directory] else [code_directory]
+
+    for root, directories, files in os.walk(code_directory):
+        root_ignored = ignored_directories[root]
+
+        walked_directories = []
+        for name in sorted(directories):
+            this_path = os.path.join(root, name)
+            ignored = is_ignored(this_path, True, root_ignored)
+            if not ignored:
+                paths.append(this_path)
+            if not ignored or ignore_rules.may_include_under(os.path.relpath(this_path, terraform_directory)):
+                ignored_directories[this_path] = ignored
+                walked_directories.append(name)
+        directories[:] = walked_directories
+
+        paths.extend(os.path.join(root, name) for name in sorted(files) if not is_ignored(os.path.join(root, name), False, root_ignored))
+
+    # The Terraform files may well live in the code directory too
+    already_included = set(paths)
+    terraform_files = [name for name in sorted(glob.glob(f"{terraform_directory}/*.tf")) if name not in already_included]
+
+    return paths + [name for name in terraform_files if not is_ignored(name, False, False)]
+
+def report_configuration(paths, top=10):
+    """ Print the size of the configuration made of [paths], and the [top] largest files and directories in it """
+
+    file_sizes = {this_path: os.lstat(this_path).st_size for this_path in paths if not os.path.isdir(this_path)}
+
+    directory_sizes = collections.Counter()
+    for this_path, size in file_sizes.items():
+        parent = os.path.dirname(this_path)
+        while parent not in ['', '.', os.sep]:
+            directory_sizes[parent] += size
+            parent = os.path.dirname(parent)
+
+    print(f"{len(file_sizes)} files, {format_size(sum(file_sizes.values()))} before compression")
+
+    print("\nLargest files:")
+    for this_path, size in sorted(file_sizes.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {format_size(size):>10}  {this_path}")
+
+    print("\nLargest directories:")
+    for this_path, size in directory_sizes.most_common(top):
+        print(f"  {format_size(size):>10}  {this_path}/")
+
+def format_size(size):
+    """ Return [size] bytes in human units """
+
+    if size < 1024:
+        return f"{size} B"
+
+    for unit in ['KiB', 'MiB', 'GiB']:
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.1f} {unit}"
+
+def hash_configuration(paths):
+    """ Return a SHA-256 hex digest covering the names, types, modes and contents of [paths] """
+
+    digest = hashlib.sha256()
+    for this_path in paths:
+        digest.update(this_path.encode() + b'\0')
+
+        if os.path.islink(this_path):
+            digest.update(b'l' + os.readlink(this_path).encode())
+        elif os.path.isdir(this_path):
+            digest.update(b'd')
+        else:
+            digest.update(b'f' + oct(os.stat(this_path).st_mode & 0o777).encode() + b'\0')
+            with open(this_path, 'rb') as this_file:
+                for block in iter(lambda: this_file.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+def package_configuration(terraform_directory, code_directory, paths=None, fileobj=None, compression_level=9, compression_workers=1):
+    """
+    Tar and Gzip the TFC configuration from [terraform_directory] and [code_directory],
+    or just [paths] if they've already been worked out with configuration_paths().
+
+    Written to a temporary file whose path is returned, unless a writable
+    [fileobj] is given, in which case it's written there as a stream and never
+    seeked. More than one of [compression_workers] compresses on that many
+    cores at once
+    """
+
+    if paths is None:
+        paths = configuration_paths(terraform_directory, code_directory)
+
+    if fileobj is None:
+        this_date = datetime.datetime.now().isoformat()
+        archive_path = os.path.join(tempfile.gettempdir(), f"{this_date}.tar.gz")
+        with open(archive_path, 'wb') as archive_file:
+            package_configuration(terraform_directory, code_directory, paths, archive_file, compression_level, compression_workers)
+
+        return archive_path
+
+    # Only packaging needs tarfile, and it's slow to import
+    import tarfile
+
+    if compression_workers > 1:
+        compressor = ParallelGzipWriter(fileobj, compression_level, compression_workers)
+    else:
+        compressor = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compression_level)
+
+    with compressor, tarfile.open(fileobj=compressor, mode="w|") as tar_file:
+        for name in paths:
+            tar_file.add(name, recursive=False)
+
+    return None
+
+def stream_configuration(paths, chunk_size=UPLOAD_CHUNK_SIZE, compression_level=9, compression_workers=1):
+    """
+    Yield the tar.gz of [paths] in chunks as it's being made. Packaging runs in
+    a separate thread, writing into a pipe, so compression and upload overlap
+    """
+
+    read_descriptor, write_descriptor = os.pipe()
+    errors = []
+
+    def package():
+        try:
+            with os.fdopen(write_descriptor, 'wb') as pipe_writer:
+                package_configuration(None, None, paths, pipe_writer, compression_level, compression_workers)
+        except BrokenPipeError:
+            # The reading side gave up (e.g. the upload failed), nothing more to do
+            pass
+        except Exception as e: # pylint: disable=broad-except
+            errors.append(e)
+
+    packager = threading.Thread(target=package, daemon=True)
+    packager.start()
+
+    with os.fdopen(read_descriptor, 'rb') as pipe_reader:
+        for chunk in iter(lambda: pipe_reader.read(chunk_size), b''):
+            yield chunk
+
+    packager.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,128 @@
+"""
+.terraformignore handling for configuration packaging
+
+Follows the same rules as Terraform itself: gitignore style patterns, read
+from .terraformignore in the root of the configuration, on top of a default
+set which leaves out .git/ and .terraform/ (but keeps .terraform/modules/)
+
+https://developer.hashicorp.com/terraform/cloud-docs/run/install-software#excluding-files-from-upload-with-terraformignore
+"""
+
+import os
+import re
+
+DEFAULT_RULES = ['.git/', '.terraform/', '!.terraform/modules/']
+
+class IgnoreRules():
+    """ An ordered set of ignore patterns, where the last pattern matching a path wins """
+
+    def __init__(self, patterns):
+        self.rules = [compile_pattern(this_pattern) for this_pattern in patterns if is_pattern(this_pattern)]
+
+    def match(self, relative_path, is_directory):
+        """
+        Return True if [relative_path] is excluded, False if it's explicitly
+        included, or None if no rule mentions it (it inherits its parent's fate)
+        """
+
+        relative_path = relative_path.replace(os.sep, '/')
+        verdict = None
+        for regex, directory_only, excluded, _ in self.rules:
+            if directory_only and not is_directory:
+                continue
+            if regex.match(relative_path):
+                verdict = excluded
+
+        return verdict
+
+    def may_include_under(self, relative_directory):
+        """
+        True if some negation rule could bring back a path under the excluded
+        [relative_directory], meaning it has to be walked rather than skipped
+        """
+
+        relative_directory = relative_directory.replace(os.sep, '/')
+        for _, _, excluded, literal_prefix in self.rules:
+            if excluded:
+                continue
+            if literal_prefix is None:
+                return True
+            if literal_prefix.startswith(relative_directory + '/') or relative_directory.startswith(literal_prefix):
+                return True
+
+        return False
+
+# Functions
+
+def load_rules(root_directory, extra_patterns=()):
+    """ Return the IgnoreRules for [root_directory]: defaults, then .terraformignore, then [extra_patterns] """
+
+    patterns = list(DEFAULT_RULES)
+    try:
+        with open(os.path.join(root_directory, '.terraformignore'), 'r') as ignore_file:
+            patterns.extend(line.rstrip('\n') for line in ignore_file)
+    except FileNotFoundError:
+        pass
+
+    return IgnoreRules(patterns + list(extra_patterns))
+
+def is_pattern(line):
+    """ Blank lines and comments aren't patterns """
+
+    return line.strip() != '' and not line.startswith('#')
+
+def compile_pattern(pattern):
+    """
+    Turn one gitignore style [pattern] into (regex, directory_only, excluded, literal_prefix).
+    [literal_prefix] is the part of an anchored pattern before any wildcards,
+    or None for patterns which can match at any depth
+    """
+
+    pattern = pattern.strip()
+    excluded = not pattern.startswith('!')
+    if not excluded:
+        pattern = pattern[1:]
+
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+
+    # A slash anywhere but the end ties the pattern to the root, otherwise it can match at any depth
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = ''
+    position = 0
+    while position < len(pattern):
+        if pattern.startswith('**/', position):
+            regex += '(?:.*/)?'
+            position += 3
+        elif pattern.startswith('/**', position) and position + 3 == len(pattern):
+            regex += '(?:/.*)?'
+            position += 3
+        elif pattern.startswith('**', position):
+            regex += '.*'
+            position += 2
+        elif pattern[position] == '*':
+            regex += '[^/]*'
+            position += 1
+        elif pattern[position] == '?':
+            regex += '[^/]'
+            position += 1
+        elif pattern[position] == '[' and ']' in pattern[position + 1:]:
+            end = pattern.index(']', position + 1)
+            character_class = pattern[position + 1:end].replace('\\', '\\\\')
+            if character_class.startswith('!'):
+                character_class = '^' + character_class[1:]
+            regex += '[' + character_class + ']'
+            position = end + 1
+        else:
+            regex += re.escape(pattern[position])
+            position += 1
+
+    if anchored:
+        literal_prefix = re.split(r'[*?\[]', pattern)[0]
+    else:
+        literal_prefix = None
+        regex = '(?:.*/)?' + regex
+
+    return re.compile(f"^{regex}$"), directory_only, excluded, literal_prefix
@@ -0,0 +1,33 @@
+"""
+Decoding of Terraform Cloud JSON responses
+
+orjson is used when it's installed (pip install terraform-cloud-deployer[fast-json]),
+as it decodes several times faster than the standard library json module,
+which is used otherwise. Either way, a response body is only ever decoded
+once, however many times it's asked for
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+    """ Decode the JSON document [data] (str or bytes) """
+
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+def decode(response):
+    """ Return the decoded JSON body of [response], decoding it on first use only """
+
+    try:
+        return response.decoded_json
+    except AttributeError:
+        response.decoded_json = loads(response.content)
+
+    return response.decoded_json
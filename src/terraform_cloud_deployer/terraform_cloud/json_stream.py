@@ -0,0 +1,265 @@
+"""
+Incremental reading of very large JSON documents
+
+Plans and statefiles can run to hundreds of megabytes. Rather than decoding
+the whole thing, these helpers walk the text as it arrives, skip over the
+parts we don't care about without holding on to them, and decode the
+elements of one top level array a single element at a time. Peak memory is
+then roughly the size of the largest element, not the size of the document
+"""
+
+import json
+import re
+
+# Characters that matter when skipping over a container, and when skipping over a string
+STRUCTURE = re.compile(r'[\[\]{}"]')
+STRING_END = re.compile(r'["\\]')
+STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+SCALAR = re.compile(r'[^,:\]}\s]+')
+WHITESPACE = re.compile(r'\s*')
+DELIMITER = re.compile(r'\s*[,:\]}]')
+
+class Scanner():
+    """ Cursor over JSON text supplied as an iterable of string chunks """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.position = 0
+        self.mark = None
+        self.exhausted = False
+
+    def fill(self):
+        """ Pull in another chunk, dropping whatever has been consumed and isn't marked. False at the end """
+
+        if self.exhausted:
+            return False
+
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            return False
+
+        cut = self.position if self.mark is None else self.mark
+        self.buffer = self.buffer[cut:] + chunk
+        self.position -= cut
+        if self.mark is not None:
+            self.mark -= cut
+
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character without consuming it, or '' at the end """
+
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+
+    def expect(self, character):
+        """ Consume [character], which must be the next non-whitespace character """
+
+        found = self.peek()
+        if found != character:
+            raise ValueError(f"Expected '{character}' in JSON stream but found '{found}'")
+        self.position += 1
+
+    def search(self, pattern):
+        """ Return the next match of [pattern] from the current position, reading more as needed """
+
+        while True:
+            match = pattern.search(self.buffer, self.position)
+            if match:
+                return match
+            self.position = len(self.buffer)
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def skip_string(self):
+        """ Move past a string whose opening quote has already been consumed """
+
+        # Usually the whole string is already in the buffer, and one regex match will do
+        match = STRING_REST.match(self.buffer, self.position)
+        if match:
+            self.position = match.end()
+            return
+
+        while True:
+            match = self.search(STRING_END)
+            if match.group() == '"':
+                self.position = match.end()
+                return
+
+            # Backslash: the escaped character must be skipped too, even if it's in the next chunk
+            self.position = match.end()
+            while self.position >= len(self.buffer):
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON stream")
+            self.position += 1
+
+    def skip_value(self):
+        """ Move past the next value, whatever it is """
+
+        first = self.peek()
+        if first == '"':
+            self.position += 1
+            self.skip_string()
+        elif first in ['{', '[']:
+            self.position += 1
+            depth = 1
+            while depth:
+                match = self.search(STRUCTURE)
+                self.position = match.end()
+                if match.group() == '"':
+                    self.skip_string()
+                elif match.group() in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+        else:
+            # Numbers, true, false and null. Make sure we aren't stopping at a chunk boundary
+            while True:
+                match = SCALAR.match(self.buffer, self.position)
+                if not match:
+                    raise ValueError(f"Unexpected character '{first}' in JSON stream")
+                if match.end() < len(self.buffer) or not self.fill():
+                    break
+            self.position = match.end()
+
+    def decode_value(self, decoder=json.JSONDecoder()):
+        """
+        Decode and return the next value. The C decoder is tried on what's
+        already buffered, and the buffer is at least doubled before each
+        retry, so values split across chunks still cost linear time
+        """
+
+        self.peek()
+        self.mark = self.position
+        try:
+            while True:
+                try:
+                    value, end = decoder.raw_decode(self.buffer, self.position)
+                    # Unless we can see what follows it, the value may have been cut short ('-25' of '-2500.0')
+                    if DELIMITER.match(self.buffer, end) or self.exhausted:
+                        self.position = end
+                        return value
+                except ValueError:
+                    if self.exhausted:
+                        raise
+
+                wanted = 2 * (len(self.buffer) - self.mark)
+                while len(self.buffer) - self.mark < wanted and self.fill():
+                    pass
+        finally:
+            self.mark = None
+
+    def read_value(self):
+        """ Return the raw text of the next value, holding on to just that much of the stream """
+
+        self.peek()
+        self.mark = self.position
+        self.skip_value()
+        text = self.buffer[self.mark:self.position]
+        self.mark = None
+
+        return text
+
+def iter_array(chunks, key, scalars=None):
+    """
+    Yield the decoded elements of the array at [key] in the top level object
+    of the JSON text in [chunks], one at a time. Reading stops once that
+    array has been consumed.
+
+    Top level scalar values seen on the way (e.g. a plan's 'applyable') are
+    stored in [scalars] if a dict is given. Raises KeyError if there is no
+    such array
+    """
+
+    scanner = Scanner(chunks)
+    scanner.expect('{')
+
+    while True:
+        next_character = scanner.peek()
+        if next_character == ',':
+            scanner.position += 1
+            continue
+        if next_character in ['}', '']:
+            raise KeyError(key)
+
+        this_key = json.loads(scanner.read_value())
+        scanner.expect(':')
+
+        if this_key == key:
+            scanner.expect('[')
+            while True:
+                next_character = scanner.peek()
+                if next_character == ']':
+                    return
+                if next_character == ',':
+                    scanner.position += 1
+                    continue
+                yield scanner.decode_value()
+
+        if scalars is not None and scanner.peek() not in ['{', '[']:
+            scalars[this_key] = json.loads(scanner.read_value())
+        else:
+            scanner.skip_value()
+
+# One token of JSON text: a whole string, a structural character, whitespace, or a bare scalar
+TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]|\s+|[^\s{}\[\],:"]+')
+
+def reindent(chunks, indent=2):
+    """
+    Yield the JSON text in [chunks] re-laid out the way json.dumps(indent=[indent])
+    would, without ever decoding the whole document
+    """
+
+    carried = ''
+    depth = 0
+    just_opened = False
+
+    for chunk in chunks:
+        text = carried + chunk
+        position = 0
+        output = []
+
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            # An unterminated string, or something which may carry on in the next chunk
+            if not match or match.end() == len(text) and text[position] not in '{}[],:':
+                break
+            token = match.group()
+            position = match.end()
+
+            if token.isspace():
+                continue
+
+            if token in '}]':
+                depth -= 1
+                output.append(token if just_opened else '\n' + ' ' * indent * depth + token)
+                just_opened = False
+                continue
+
+            if just_opened:
+                output.append('\n' + ' ' * indent * depth)
+                just_opened = False
+
+            if token in '{[':
+                output.append(token)
+                depth += 1
+                just_opened = True
+            elif token == ',':
+                output.append(',\n' + ' ' * indent * depth)
+            elif token == ':':
+                output.append(': ')
+            else:
+                output.append(token)
+
+        carried = text[position:]
+        yield ''.join(output)
+
+    if carried.strip():
+        yield carried.strip()
@@ -0,0 +1,68 @@
+"""
+Following plan and apply logs as they're written
+
+Plans and applies have a log-read-url. Each read asks only for the bytes
+after the last one already seen (an HTTP Range request), so a long log is
+never downloaded twice however often it's checked. Terraform Cloud wraps a
+log in STX and ETX characters, and the ETX tells us the log is complete
+
+https://developer.hashicorp.com/terraform/cloud-docs/api-docs/plans#retrieve-the-json-execution-plan
+"""
+
+import codecs
+import logging
+import sys
+import requests
+
+START_OF_LOG = '\x02'
+END_OF_LOG = '\x03'
+
+class LogTail():
+    """ Copies the log at [url] to [output] (stderr by default), a little more each time poll() is called """
+
+    def __init__(self, tfc_client, url, output=None):
+        self.tfc_client = tfc_client
+        self.url = url
+        # Looked up now rather than as a default, as 'tfcd serve' swaps stderr for each command
+        self.output = output or sys.stderr
+
+        self.offset = 0
+        self.finished = False
+        # Characters can be split across reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def poll(self):
+        """ Write out whatever has been added to the log since the last call. Returns how many bytes that was """
+
+        if self.finished:
+            return 0
+
+        headers = {'Range': f"bytes={self.offset}-"} if self.offset else {}
+        try:
+            response = self.tfc_client.get(self.url, headers=headers)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Could not read the log, will try again: {e}")
+            return 0
+
+        # Nothing past the end of what we have yet
+        if response.status_code == 416:
+            return 0
+        if response.status_code not in [200, 206]:
+            logging.warning(f"Could not read the log, will try again: HTTP {response.status_code}")
+            return 0
+
+        content = response.content
+        # The whole log came back rather than just the range asked for
+        if response.status_code == 200:
+            content = content[self.offset:]
+        self.offset += len(content)
+
+        text = self.decoder.decode(content)
+        if END_OF_LOG in text:
+            text = text[:text.index(END_OF_LOG)]
+            self.finished = True
+
+        self.output.write(text.replace(START_OF_LOG, ''))
+        self.output.flush()
+
+        return len(content)
@@ -0,0 +1,139 @@
+"""
+Run events pushed by Terraform Cloud, instead of polled for
+
+A generic notification configuration on the workspace has Terraform Cloud
+POST run events to a small HTTP receiver run by tfcd. Every payload is
+signed with a token only we know (HMAC-SHA512, in the
+X-TFE-Notification-Signature header), so anything else is turned away
+
+https://developer.hashicorp.com/terraform/cloud-docs/api-docs/notification-configurations
+https://developer.hashicorp.com/terraform/cloud-docs/workspaces/settings/notifications#notification-authenticity
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import secrets
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from terraform_cloud_deployer.terraform_cloud.json_backend import decode, loads
+
+NOTIFICATION_NAME = 'tfcd run wait'
+
+# Sent when a run stops of its own accord: done, failed, or waiting for someone
+SETTLED_TRIGGERS = ['run:completed', 'run:errored', 'run:needs_attention']
+
+class NotificationReceiver():
+    """
+    HTTP server on [host]:[port] which checks each POST is signed with
+    [token], and queues the decoded payloads for wait_for_run()
+    """
+
+    def __init__(self, host, port, token):
+        self.token = token.encode('utf-8')
+        self.events = queue.Queue()
+
+        receiver = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                signature = self.headers.get('X-TFE-Notification-Signature', '')
+                if not hmac.compare_digest(hmac.new(receiver.token, body, hashlib.sha512).hexdigest(), signature):
+                    logging.warning(f"Ignoring a notification with a bad signature from {self.client_address[0]}")
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.end_headers()
+                try:
+                    receiver.events.put(loads(body))
+                except ValueError:
+                    logging.warning("Ignoring a notification which isn't JSON")
+
+            def log_message(self, format, *args):
+                logging.debug(f"Notification receiver: {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        # A short poll interval, so shutting down doesn't hold up returning the result
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for_run(self, run_id, timeout):
+        """
+        Return the status of [run_id] from the first notification saying it
+        has settled, or None if there's none within [timeout] seconds
+        """
+
+        try:
+            while True:
+                payload = self.events.get(timeout=timeout)
+                if payload.get('run_id') != run_id:
+                    continue
+
+                for this_notification in payload.get('notifications', []):
+                    logging.info(f"Notification for {run_id}: {this_notification.get('message')}")
+                    if this_notification.get('trigger') in SETTLED_TRIGGERS:
+                        return this_notification.get('run_status')
+        except queue.Empty:
+            return None
+
+# Functions
+
+def new_token():
+    """ A fresh secret to sign notifications with """
+
+    return secrets.token_hex(32)
+
+def register_notification(tfc_client, workspace_id, url, token):
+    """
+    Have Terraform Cloud send run events for [workspace_id] to [url], signed
+    with [token]. Our configuration from last time is reused (with the new
+    token) if it's there, rather than piling up new ones. Returns its ID
+    """
+
+    notifications_url = f"{tfc_client.tfc_root_url}/workspaces/{workspace_id}/notification-configurations"
+    attributes = {
+        'destination-type': 'generic',
+        'enabled': True,
+        'name': NOTIFICATION_NAME,
+        'token': token,
+        'triggers': SETTLED_TRIGGERS,
+        'url': url
+    }
+
+    response = tfc_client.get(notifications_url)
+    response.raise_for_status()
+    for this_configuration in decode(response).get('data', []):
+        if this_configuration['attributes'].get('name') == NOTIFICATION_NAME and this_configuration['attributes'].get('url') == url:
+            response = tfc_client.patch(f"{tfc_client.tfc_root_url}/notification-configurations/{this_configuration['id']}",
+                                        data=json.dumps({'data': {'type': 'notification-configurations', 'attributes': attributes}}))
+            response.raise_for_status()
+            return this_configuration['id']
+
+    # Terraform Cloud sends a verification request to [url] before this returns, so the receiver has to be up already
+    response = tfc_client.post(notifications_url,
+                               data=json.dumps({'data': {'type': 'notification-configurations', 'attributes': attributes}}))
+    response.raise_for_status()
+
+    return decode(response)['data']['id']
+
+def disable_notification(tfc_client, notification_id):
+    """ Stop [notification_id] sending to a receiver which has gone away """
+
+    try:
+        tfc_client.patch(f"{tfc_client.tfc_root_url}/notification-configurations/{notification_id}",
+                         data=json.dumps({'data': {'type': 'notification-configurations', 'attributes': {'enabled': False}}}))
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Could not disable notification configuration {notification_id}: {e}")
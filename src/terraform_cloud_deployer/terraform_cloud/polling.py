@@ -0,0 +1,50 @@
+"""
+Backoff strategy for waiting on Terraform Cloud to finish something
+
+Polls start out close together, so that quick operations (speculative plans,
+small uploads) are noticed almost as soon as they're done, and then spread out
+up to a ceiling so that long waits don't hammer the API
+"""
+
+import random
+import time
+import logging
+
+class Poller():
+    """ Exponential backoff with jitter, bounded by an overall deadline """
+
+    def __init__(self, initial_interval=1, max_interval=15, timeout=900, factor=2):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.factor = factor
+
+    def intervals(self):
+        """ Yield successive sleep lengths forever, growing by [factor] up to [max_interval] """
+
+        interval = self.initial_interval
+        while True:
+            # 'Equal jitter': never less than half the interval, so we still back
+            # off, but spread out enough that parallel pipelines don't poll in step
+            yield interval / 2 + random.uniform(0, interval / 2)
+            interval = min(interval * self.factor, self.max_interval)
+
+    def attempts(self):
+        """
+        Yield once straight away, then again after each backoff sleep, until
+        [timeout] seconds have passed. Callers break out of the loop when
+        they're done; falling out of the bottom means the deadline was hit
+        """
+
+        deadline = time.monotonic() + self.timeout
+        yield
+
+        for this_interval in self.intervals():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            this_interval = min(this_interval, remaining)
+            logging.debug(f"Polling again in {this_interval:.1f} seconds")
+            time.sleep(this_interval)
+            yield
@@ -0,0 +1,90 @@
+"""
+Client side rate limiting for the Terraform Cloud API
+
+Terraform Cloud allows 30 requests a second per token, and answers anything
+over that with a 429. Every API call made through the Client takes a token
+from this bucket first, and the bucket is kept honest by the X-RateLimit-*
+headers on every response
+
+https://developer.hashicorp.com/terraform/cloud-docs/api-docs#rate-limiting
+"""
+
+import threading
+import time
+import logging
+
+class TokenBucket():
+    """ Thread safe token bucket, refilled at [rate] tokens a second """
+
+    def __init__(self, rate=30):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request is allowed, then take a token for it """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def block_for(self, seconds):
+        """ Let nothing through for [seconds] """
+
+        with self.lock:
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+        logging.info(f"Rate limited by Terraform Cloud, holding off for {seconds:.2f} seconds")
+
+    def update(self, headers):
+        """ Bring the bucket in line with the X-RateLimit-* [headers] of a response """
+
+        limit = header_number(headers, 'X-RateLimit-Limit')
+        remaining = header_number(headers, 'X-RateLimit-Remaining')
+        reset = header_number(headers, 'X-RateLimit-Reset')
+
+        with self.lock:
+            if limit:
+                self.rate = min(self.rate, limit)
+                self.capacity = self.rate
+            if remaining is not None:
+                # Another process sharing the token may have used up more than we know about
+                self.tokens = min(self.tokens, remaining)
+
+        if remaining is not None and remaining < 1 and reset:
+            self.block_for(reset)
+
+# Functions
+
+def header_number(headers, name):
+    """ Return header [name] from [headers] as a float, or None if it's missing or junk """
+
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def retry_after(response, default=1):
+    """ Seconds to wait before retrying a throttled [response] """
+
+    for name in ['Retry-After', 'X-RateLimit-Reset']:
+        seconds = header_number(response.headers, name)
+        if seconds is not None:
+            return max(seconds, 0)
+
+    return default
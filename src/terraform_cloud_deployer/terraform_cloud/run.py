@@ -9,27 +9,46 @@ import json
 from pprint import pprint
 import sys
 import re
-import time
 import logging
+import codecs
+import time
+
+from terraform_cloud_deployer.terraform_cloud.json_stream import iter_array
+from terraform_cloud_deployer.terraform_cloud.json_backend import decode
+from terraform_cloud_deployer.terraform_cloud.logs import LogTail
+from terraform_cloud_deployer.terraform_cloud import notifications
+from terraform_cloud_deployer.terraform_cloud.polling import Poller
+from terraform_cloud_deployer.terraform_cloud.watcher import is_settled
+from terraform_cloud_deployer.terraform_cloud.workspace import Workspace
+
+# Plans are read in pieces of this size, so they never have to be held in memory whole
+PLAN_CHUNK_SIZE = 65536
+
+# JSON:API types (and endpoints) of a run's phases
+PHASE_TYPES = {'plan': 'plans', 'apply': 'applies'}
+
+# A plan or apply in one of these states has stopped, one way or another
+PHASE_DONE_STATUSES = ['finished', 'errored', 'canceled', 'unreachable']
+
+# When waiting on notifications, how long to go without one before checking on the run anyway
+NOTIFICATION_FALLBACK_INTERVAL = 60
+
+# The run attributes (and relationships) summarise_run() reads, so listings don't fetch the rest
+RUN_SUMMARY_FIELDS = ['created-at', 'status', 'status-timestamps', 'plan']
 
 class Run():
     """ Methods for creating and interacting with Terraform Cloud runs """
 
-    def __init__(self, tfc_api_token, tfc_root_url, tfc_organisation, tfc_workspace):
+    def __init__(self, tfc_client, tfc_organisation, tfc_workspace, poller=None, log_output=None):
         self.tfc_workspace = tfc_workspace
-        self.tfc_api_token = tfc_api_token
-        self.tfc_root_url = tfc_root_url
+        self.tfc_client = tfc_client
+        self.poller = poller or Poller()
+        # Where to copy the plan log while waiting on a plan, if anywhere
+        self.log_output = log_output
+        self.tfc_root_url = tfc_client.tfc_root_url
         self.tfc_organisation = tfc_organisation
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
-        try:
-            workspace_response = requests.get(f"{self.tfc_root_url}/organizations/{tfc_organisation}/workspaces/{tfc_workspace}", headers=headers)
-            workspace_response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            print(f"Error getting information on workspace {self.tfc_workspace}. Does the token you're using have access to it?:\n{e}")
-            sys.exit(1)
-
-        self.workspace_id = workspace_response.json()['data']['id']
+        self.workspace_id = Workspace(tfc_client, tfc_organisation).get_workspace_id(tfc_workspace)
 
     def queue(self, configuration_id, wait):
         """
@@ -61,24 +80,24 @@ class Run():
           }
         })
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            response = requests.post(
+            response = self.tfc_client.post(
                                     f"{self.tfc_root_url}/runs",
-                                    headers=headers,
                                     data=run_data)
         except requests.exceptions.HTTPError as e:
             print(f"Error queuing a run in workspace {self.tfc_workspace} for configuration id {configuration_id}:\n{e}")
             sys.exit(1)
 
         # TODO: Catch this when there's no data
-        run_id = response.json()['data']['id']
-        plan_id = response.json()['data']['relationships']['plan']['data']['id']
+        response_json = decode(response)
+        run_id = response_json['data']['id']
+        plan_id = response_json['data']['relationships']['plan']['data']['id']
 
         if wait:
             # TODO: If we print here, we'd have to write the outputs of the CICD commands to
             #       a file instead, else this output would be included to the next CICD job
-            self.get_plan(plan_id)
+            for _ in self.iter_plan(plan_id):
+                pass
 
         return json.dumps({
           "run_url": f"https://app.terraform.io/app/{self.tfc_organisation}/workspaces/{self.tfc_workspace}/runs/{run_id}",
@@ -89,35 +108,45 @@ class Run():
     def get_plan_id(self, run_id):
         """ Get plan_id for [run_id] """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
+        return self.get_run_plan(run_id)['id']
+
+    def get_run_plan(self, run_id):
+        """
+        Return the plan of [run_id], fetched along with the run in a single
+        call by having it included in the response
+        """
+
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                 f"{self.tfc_root_url}/runs/{run_id}",
-                headers=headers)
+                params={'include': 'plan', 'fields[runs]': 'plan', 'fields[plans]': 'status'})
         except requests.exceptions.HTTPError as e:
             print(f"Error getting plan:\n{e}")
             sys.exit(1)
 
-        response_json = response.json()
+        response_json = decode(response)
         plan_id = response_json['data']['relationships']['plan']['data']['id']
+        for this_resource in response_json.get('included', []):
+            if this_resource['type'] == 'plans' and this_resource['id'] == plan_id:
+                return this_resource
 
-        return plan_id
+        return {'id': plan_id, 'type': 'plans'}
 
-    def get_plan_metadata(self, plan_id):
+    def get_plan_metadata(self, plan_id, fields=None):
         """
-        Return information on [plan_id]
+        Return information on [plan_id], limited to the attributes in [fields] if given
         """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
+        params = {'fields[plans]': ','.join(fields)} if fields else None
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                 f"{self.tfc_root_url}/plans/{plan_id}",
-                headers=headers)
+                params=params)
         except requests.exceptions.HTTPError as e:
             print(f"Error getting plan:\n{e}")
             sys.exit(1)
 
-        return response.json()
+        return decode(response)
 
     def get_plan(self, plan_id):
         """
@@ -125,66 +154,142 @@ class Run():
         Can secretly also accept a run_id as [plan_id], and work out the plan_id.
 
         Note that it's possible the plan isn't available, in which case the self.wait_for_plan()
-        method this method uses will timeout after five minutes
+        method this method uses will give up once the poller's deadline is reached.
+
+        This holds every change in memory at once; use self.iter_plan() for large plans
         """
 
-        url_plan_matches = re.match('plan-.*', plan_id)
-        if not url_plan_matches:
-            plan_id = self.get_plan_id(plan_id)
+        return dict(self.iter_plan(plan_id))
+
+    def iter_plan(self, plan_id):
+        """
+        Like self.get_plan(), but yields (address, change) pairs one at a time
+        as the JSON plan is streamed in, so memory use doesn't grow with the
+        size of the plan
+        """
 
-        self.wait_for_plan(plan_id)
+        url_plan_matches = re.match('plan-.*', plan_id)
+        if url_plan_matches:
+            self.wait_for_plan(plan_id)
+        else:
+            # The run's plan comes with its status, which saves a poll if it's already finished
+            plan = self.get_run_plan(plan_id)
+            plan_id = plan['id']
+            self.wait_for_plan(plan_id, plan.get('attributes', {}).get('status'))
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                 f"{self.tfc_root_url}/plans/{plan_id}/json-output",
-                headers=headers)
+                stream=True)
             if response.status_code == 404:
                 raise requests.exceptions.HTTPError(response.reason)
         except requests.exceptions.HTTPError as e:
             print(f"Error getting plan: {e}")
             sys.exit(1)
 
-        if response.status_code == 204:
-            plan_information = self.get_plan_metadata(plan_id)
-            status = plan_information['data']['attributes']['status']
-            print(f"The status is listed as listed as '{status}', which means we can't fetch the plan")
-            sys.exit(0)
+        with response:
+            if response.status_code == 204:
+                plan_information = self.get_plan_metadata(plan_id, fields=['status'])
+                status = plan_information['data']['attributes']['status']
+                print(f"The status is listed as listed as '{status}', which means we can't fetch the plan")
+                sys.exit(0)
+
+            plan_scalars = {}
+            plan_chunks = codecs.iterdecode(response.iter_content(chunk_size=PLAN_CHUNK_SIZE), 'utf-8')
+            try:
+                for this_change in iter_array(plan_chunks, 'resource_changes', plan_scalars):
+                    yield parse_resource_change(this_change)
+            except KeyError:
+                print(f"Trouble parsing the plan. Are you sure it ran? The 'applyable' field was marked as '{plan_scalars.get('applyable')}'")
+
+    def wait_for_plan(self, plan_id, status=None):
+        """
+        Wait for a plan to finish, backing off between polls. Return False on
+        timeout or error. A [status] already known saves the first poll.
+        The plan log is copied to self.log_output as it grows, if that's set
+        """
 
-        return parse_plan(response.json())
+        known_status = status
+        log_tail = None
+        for _ in self.poller.attempts():
+            if known_status:
+                status = known_status
+                known_status = None
+            else:
+                plan_attributes = self.get_plan_metadata(plan_id, fields=['status', 'log-read-url'] if self.log_output else ['status'])['data']['attributes']
+                status = plan_attributes['status']
+                if self.log_output and log_tail is None and plan_attributes.get('log-read-url'):
+                    log_tail = LogTail(self.tfc_client, plan_attributes['log-read-url'], self.log_output)
 
-    def wait_for_plan(self, plan_id):
-        """ Wait five minutes for a plan to finish, return False on timeout or error """
+            # After the status, so a finished plan's log is read to the end
+            if log_tail:
+                log_tail.poll()
 
-        status = self.get_plan_metadata(plan_id)['data']['attributes']['status']
-        timeout = 300
-        timer = 0
-        while status != 'finished':
-            logging.debug(f"Wating for plan, current status is: {status}")
+            if status == 'finished':
+                return True
 
             if status in ['errored', 'canceled', 'unreachable']:
                 print(f"The plan is irrecoverable. The last status report was: '{status}'")
                 return False
-            if status == 'pending' and timer >= timeout:
-                print(f"The run was successfully queued, but the timeout has been reached waiting for it to start")
-                print(f"You can try getting the plan again later by quering the plan_id: '{plan_id}'")
-                return False
 
-            status = self.get_plan_metadata(plan_id)['data']['attributes']['status']
-            logging.info(f"Plan status is currently '{status}'. Sleeping for 10 seconds and trying again")
-            timer += 10
-            time.sleep(10)
+            logging.info(f"Plan status is currently '{status}'. Waiting and trying again")
+
+        print(f"The run was successfully queued, but the timeout was reached waiting for the plan to finish. The last status report was: '{status}'")
+        print(f"You can try getting the plan again later by quering the plan_id: '{plan_id}'")
+        return False
+
+    def tail_log(self, run_id, phase='plan', output=None):
+        """
+        Copy the log of [run_id]'s [phase] ('plan' or 'apply') to [output]
+        (stderr by default) as it's written, reading only what's new each
+        time. Return the phase's status once it has stopped and its log is
+        complete, or None if the poller's deadline passes first
+        """
 
-        return True
+        phase_type = PHASE_TYPES[phase]
+        try:
+            response = self.tfc_client.get(
+                f"{self.tfc_root_url}/runs/{run_id}",
+                params={'include': phase, 'fields[runs]': phase, f"fields[{phase_type}]": 'status,log-read-url'})
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error getting run {run_id}:\n{e}")
+            sys.exit(1)
+
+        response_json = decode(response)
+        phase_id = response_json['data']['relationships'][phase]['data']['id']
+        phase_attributes = next((this_resource['attributes'] for this_resource in response_json.get('included', [])
+                                 if this_resource['id'] == phase_id), {})
+
+        log_tail = None
+        for attempt_number, _ in enumerate(self.poller.attempts()):
+            if attempt_number:
+                try:
+                    response = self.tfc_client.get(f"{self.tfc_root_url}/{phase_type}/{phase_id}",
+                                                   params={f"fields[{phase_type}]": 'status,log-read-url'})
+                    response.raise_for_status()
+                    phase_attributes = decode(response)['data']['attributes']
+                except requests.exceptions.RequestException as e:
+                    # Try again on the next poll
+                    logging.warning(f"Could not get the status of {phase_id}: {e}")
+                    continue
+
+            if log_tail is None and phase_attributes.get('log-read-url'):
+                log_tail = LogTail(self.tfc_client, phase_attributes['log-read-url'], output)
+            if log_tail:
+                log_tail.poll()
+
+            if phase_attributes.get('status') in PHASE_DONE_STATUSES and (log_tail is None or log_tail.finished):
+                return phase_attributes['status']
+
+        return None
 
     def apply(self, run_id, comment=None):
         """ Attempt to apply a plan """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            response = requests.post(
-                                    f"{self.tfc_root_url}/runs/{run_id}/actions/apply",
-                                    headers=headers)
+            response = self.tfc_client.post(
+                                    f"{self.tfc_root_url}/runs/{run_id}/actions/apply")
         except requests.exceptions.HTTPError as e:
             print(f"Error applying run_id {run_id}:\n{e}")
             sys.exit(1)
@@ -217,7 +322,6 @@ class Run():
 
 
         comment = comment or '{"comment": "Cancelled by the tfcd cancel command"}'
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
 
         print(f"Run '{run_id}' will be cancelled")
         run_info = self.get_run(run_id)
@@ -233,32 +337,99 @@ class Run():
                 sys.exit(0)
 
         try:
-            requests.post(
+            self.tfc_client.post(
                           f"{self.tfc_root_url}/runs/{run_id}/actions/cancel",
-                          headers=headers,
                           data=comment)
             print('Cancelled the run, moving on to discarding ...')
-            requests.post(
+            self.tfc_client.post(
                           f"{self.tfc_root_url}/runs/{run_id}/actions/discard",
-                          headers=headers,
                           data=comment)
             print('Discarded the run')
         except Exception as e:
             print(f"Could not cancel run {run_id}: {e}")
 
+    def wait(self, run_id, listen=None, public_url=None):
+        """
+        Wait until [run_id] has finished or is waiting on someone, and return
+        its status, or None if the poller's deadline passes first.
+
+        With [listen] ('host:port'), Terraform Cloud is asked to send run
+        events to a receiver listening there ([public_url] is the address it
+        should use to reach it, if that's different). The run is then only
+        checked on directly now and again, in case a notification goes missing
+        """
+
+        if not listen:
+            return self.poll_until_settled(run_id)
+
+        host, port = listen.rsplit(':', 1)
+        token = notifications.new_token()
+        deadline = time.monotonic() + self.poller.timeout
+        with notifications.NotificationReceiver(host, int(port), token) as receiver:
+            try:
+                notification_id = notifications.register_notification(self.tfc_client, self.workspace_id, public_url or f"http://{listen}/", token)
+            except requests.exceptions.RequestException as e:
+                # e.g. Terraform Cloud couldn't reach the receiver to verify it, or the token can't manage notifications
+                logging.warning(f"Could not register for notifications, polling instead: {e}")
+                notification_id = None
+
+            try:
+                while notification_id:
+                    # Also catches the run having settled before we were listening
+                    this_run = self.get_run_state(run_id)
+                    if is_settled(this_run):
+                        return this_run['attributes']['status']
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+
+                    status = receiver.wait_for_run(run_id, min(NOTIFICATION_FALLBACK_INTERVAL, remaining))
+                    if status:
+                        return status
+            finally:
+                if notification_id:
+                    notifications.disable_notification(self.tfc_client, notification_id)
+
+        return self.poll_until_settled(run_id)
+
+    def poll_until_settled(self, run_id):
+        """ wait(), by polling alone """
+
+        for _ in self.poller.attempts():
+            this_run = self.get_run_state(run_id)
+            if is_settled(this_run):
+                return this_run['attributes']['status']
+            logging.info(f"Run status is currently '{this_run['attributes']['status']}'. Waiting and trying again")
+
+        return None
+
+    def get_run_state(self, run_id):
+        """ Return [run_id] with just the attributes needed to tell whether it has settled """
+
+        try:
+            response = self.tfc_client.get(
+                 f"{self.tfc_root_url}/runs/{run_id}",
+                 params={'fields[runs]': 'status,actions'})
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error getting run {run_id}:\n{e}")
+            sys.exit(1)
+
+        return decode(response)['data']
+
     def get_run(self, run_id):
         """ Return information on <run_id> """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
-
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                  f"{self.tfc_root_url}/runs/{run_id}",
-                 headers=headers)
+                 params={'fields[runs]': 'status'})
 
+            run_data = decode(response).get('data')
             run_info = {
-                'run_id': response.json().get('data')['id'],
-                'status': response.json().get('data').get('attributes').get('status')
+                'run_id': run_data['id'],
+                'status': run_data.get('attributes').get('status')
             }
         except Exception as e:
             print(f"Something went wrong whilst trying to fetch information on run '{run_id}':\n{e}")
@@ -269,16 +440,15 @@ class Run():
     def get_current(self):
         """ Return information on the current or last run """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
-
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                  f"{self.tfc_root_url}/workspaces/{self.workspace_id}/runs",
-                 headers=headers)
+                 params={'page[size]': 1, 'fields[runs]': 'status'})
 
+            run_data = decode(response).get('data')[0]
             run_info = {
-                'run_id': response.json().get('data')[0]['id'],
-                'status': response.json().get('data')[0].get('attributes').get('status')
+                'run_id': run_data['id'],
+                'status': run_data.get('attributes').get('status')
             }
         except IndexError as e:
             print("TFC knows nothing about this workspace's runs. Unless this this is the very first run, it's likely something's wrong, and you should proceed with caution")
@@ -288,45 +458,88 @@ class Run():
 
         return run_info
 
-    def list(self, full_output, filters):
-        """ List runs for <self.workspace_id> """
+    def list(self, full_output, filters, limit=None, stop_on=None):
+        """
+        Print runs for <self.workspace_id> a page at a time, newest first.
+
+        Stops early once [limit] runs have been printed, or after the page
+        containing a run whose attributes match all of [stop_on] (a dict of
+        attribute name to value, e.g. {'status': 'applied'})
+        """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
+        # The full output is everything; otherwise only what's shown or matched on needs fetching
+        fields = None
+        if not full_output:
+            fields = RUN_SUMMARY_FIELDS + [key for key in (stop_on or {}) if key not in RUN_SUMMARY_FIELDS + ['id']]
 
-        # TODO: Needs pagination. This only grabs the first page
-        runs = requests.get(
-                 f"{self.tfc_root_url}/workspaces/{self.workspace_id}/runs",
-                 headers=headers,
-                 params=filters)
+        printed = 0
+        for this_page in self.iter_run_pages(filters, fields):
+            if limit is not None:
+                this_page = this_page[:limit - printed]
+
+            if full_output:
+                run_output = this_page
+            else:
+                run_output = [self.summarise_run(this_run) for this_run in this_page]
 
-        if runs.status_code != 200:
-            errors = [message['detail'] for message in json.loads(runs.text)['errors']]
-            for this_error in errors:
-                print(this_error)
+            pprint(run_output)
+            printed += len(this_page)
+
+            if limit is not None and printed >= limit:
+                break
+            if stop_on and any(run_matches(this_run, stop_on) for this_run in this_page):
+                break
+
+    def iter_run_pages(self, filters, fields=None):
+        """
+        Lazily yield each page (a list of runs) for <self.workspace_id>,
+        following the pagination links only as far as the caller reads.
+        Only the run attributes in [fields] are fetched, if given
+        """
+
+        params = dict(filters)
+        if fields:
+            params['fields[runs]'] = ','.join(fields)
+        next_page = params.pop('page[number]', 1)
+        while next_page:
+            params['page[number]'] = next_page
+            try:
+                runs = self.tfc_client.get(
+                         f"{self.tfc_root_url}/workspaces/{self.workspace_id}/runs",
+                         params=params)
+            except requests.exceptions.HTTPError as e:
+                print(f"Error listing runs:\n{e}")
                 sys.exit(1)
 
-        if full_output:
-            run_output = runs.json().get('data')
-        else:
-            run_output = []
-            for this_run in runs.json().get('data'):
-                run_id = this_run.get('id')
-                created_at = this_run.get('attributes').get('created-at')
-                status = this_run.get('attributes').get('status')
-                status_timestamps = this_run.get('attributes').get('status-timestamps')
-                run_url = f"{self.tfc_root_url}/runs/{run_id}"
-                plan_id = this_run.get('relationships').get('plan').get('data').get('id')
-                site_url = f"https://app.terraform.io/app/{self.tfc_organisation}/workspaces/{self.tfc_workspace}/runs/{run_id}"
-
-                run_output.append({'id': run_id,
-                                   'created_at': created_at,
-                                   'status': status,
-                                   'status_timestamp': status_timestamps,
-                                   'run_url': run_url,
-                                   'plan_id': plan_id,
-                                   'site_url': site_url})
-
-        pprint(run_output)
+            if runs.status_code != 200:
+                errors = [message['detail'] for message in decode(runs)['errors']]
+                for this_error in errors:
+                    print(this_error)
+                sys.exit(1)
+
+            runs_json = decode(runs)
+            yield runs_json.get('data')
+
+            next_page = runs_json.get('meta', {}).get('pagination', {}).get('next-page')
+
+    def summarise_run(self, this_run):
+        """ Return the handful of fields from [this_run] we show when not asked for full output """
+
+        run_id = this_run.get('id')
+        created_at = this_run.get('attributes').get('created-at')
+        status = this_run.get('attributes').get('status')
+        status_timestamps = this_run.get('attributes').get('status-timestamps')
+        run_url = f"{self.tfc_root_url}/runs/{run_id}"
+        plan_id = this_run.get('relationships').get('plan').get('data').get('id')
+        site_url = f"https://app.terraform.io/app/{self.tfc_organisation}/workspaces/{self.tfc_workspace}/runs/{run_id}"
+
+        return {'id': run_id,
+                'created_at': created_at,
+                'status': status,
+                'status_timestamp': status_timestamps,
+                'run_url': run_url,
+                'plan_id': plan_id,
+                'site_url': site_url}
 
 ### Functions
 
@@ -337,13 +550,25 @@ def parse_plan(plan_json):
 
     try:
         for this_change in plan_json['resource_changes']:
-
-            parsed_output[this_change['address']] = {
-                'change_types': this_change['change']['actions'],
-                'change_before': this_change['change']['before'],
-                'change_after': this_change['change']['after']
-            }
+            address, parsed_change = parse_resource_change(this_change)
+            parsed_output[address] = parsed_change
     except KeyError:
         print(f"Trouble parsing the plan. Are you sure it ran? The 'applyable' field was marked as '{plan_json['applyable']}'")
 
     return parsed_output
+
+def parse_resource_change(this_change):
+    """ Return (address, {change_types, change_before, change_after}) for one of a plan's resource_changes """
+
+    return this_change['address'], {
+        'change_types': this_change['change']['actions'],
+        'change_before': this_change['change']['before'],
+        'change_after': this_change['change']['after']
+    }
+
+def run_matches(this_run, conditions):
+    """ True if every attribute named in [conditions] has the given value on [this_run] """
+
+    attributes = dict(this_run.get('attributes'), id=this_run.get('id'))
+
+    return all(str(attributes.get(key)) == value for key, value in conditions.items())
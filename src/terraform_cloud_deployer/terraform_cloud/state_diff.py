@@ -0,0 +1,113 @@
+"""
+Differences between two statefiles, by resource instance
+
+Each statefile is read as a stream and boiled down to one hash of the
+attributes per resource instance, keyed by its address. Only the instances
+whose hashes differ are then read again and compared attribute by attribute,
+so the work is linear in the size of the statefiles and memory only goes on
+the instances which actually changed
+"""
+
+import codecs
+import hashlib
+import json
+
+from terraform_cloud_deployer.terraform_cloud.json_stream import iter_array
+
+# Built once, rather than on every json.dumps() call
+CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+
+def iter_instances(chunks, scalars=None):
+    """
+    Yield (address, instance) for every resource instance in the statefile
+    [chunks] (bytes). Top level scalars (serial, lineage...) go in [scalars]
+    """
+
+    chunks = iter(chunks)
+    for resource in iter_array(codecs.iterdecode(chunks, 'utf-8'), 'resources', scalars):
+        for instance in resource.get('instances', []):
+            yield instance_address(resource, instance), instance
+
+    # Read to the end, so whatever is handing out the chunks (e.g. the state cache) sees them all
+    for _ in chunks:
+        pass
+
+def instance_address(resource, instance):
+    """
+    The address Terraform itself would give [instance] of [resource], e.g.
+    module.a.aws_s3_bucket.b["c"]. A deposed object (the old instance left
+    behind by create_before_destroy) gets its key on the end, as in plans
+    """
+
+    address = f"{resource['type']}.{resource['name']}"
+    if resource.get('mode') == 'data':
+        address = f"data.{address}"
+    if resource.get('module'):
+        address = f"{resource['module']}.{address}"
+    if 'index_key' in instance:
+        index_key = instance['index_key']
+        address += f"[{json.dumps(index_key) if isinstance(index_key, str) else index_key}]"
+    if instance.get('deposed'):
+        address += f" (deposed object {instance['deposed']})"
+
+    return address
+
+def hash_attributes(instance):
+    """ A digest of the attributes of [instance] which doesn't depend on key order """
+
+    attributes = CANONICAL_ENCODER.encode(instance.get('attributes'))
+
+    return hashlib.sha256(attributes.encode('utf-8')).digest()
+
+def index_state(chunks, scalars=None):
+    """ Return {address: attribute hash} for the statefile [chunks] """
+
+    return {address: hash_attributes(instance) for address, instance in iter_instances(chunks, scalars)}
+
+def collect_instances(chunks, addresses):
+    """ Return {address: attributes} for just the instances in [addresses] """
+
+    return {address: instance.get('attributes') for address, instance in iter_instances(chunks) if address in addresses}
+
+def changed_paths(old, new, path=''):
+    """ Yield the paths (e.g. tags.Name, ingress[0].cidr_blocks) at which [old] and [new] differ """
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(old.keys() | new.keys(), key=str):
+            if old.get(key) != new.get(key):
+                yield from changed_paths(old.get(key), new.get(key), f"{path}.{key}" if path else str(key))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for position, (old_item, new_item) in enumerate(zip(old, new)):
+            if old_item != new_item:
+                yield from changed_paths(old_item, new_item, f"{path}[{position}]")
+    else:
+        yield path or '(everything)'
+
+def diff_states(open_old, open_new):
+    """
+    Compare two statefiles. [open_old] and [open_new] are called to get the
+    chunks of each statefile, as the changed instances are read a second time.
+    Returns a dict of 'added' and 'removed' addresses, 'changed' as
+    {address: [changed paths]}, and the top level 'old' and 'new' scalars
+    """
+
+    old_scalars, new_scalars = {}, {}
+    old_index = index_state(open_old(), old_scalars)
+    new_index = index_state(open_new(), new_scalars)
+
+    changed = {address for address in old_index.keys() & new_index.keys() if old_index[address] != new_index[address]}
+    differences = {
+        'added': sorted(new_index.keys() - old_index.keys()),
+        'removed': sorted(old_index.keys() - new_index.keys()),
+        'changed': {},
+        'old': old_scalars,
+        'new': new_scalars
+    }
+
+    if changed:
+        old_attributes = collect_instances(open_old(), changed)
+        new_attributes = collect_instances(open_new(), changed)
+        for address in sorted(changed):
+            differences['changed'][address] = list(changed_paths(old_attributes[address], new_attributes[address]))
+
+    return differences
@@ -0,0 +1,80 @@
+"""
+Large downloads that survive dropped connections
+
+If the connection goes away part way through, the download carries on from
+the last byte received with an HTTP Range request, rather than starting again
+"""
+
+import logging
+import requests
+
+# Big enough that per-chunk overhead doesn't matter, small enough to not matter for memory
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+class ResumableDownload():
+    """
+    Readable, non-seekable file object over [url], starting at byte [offset].
+    Chunks can also be taken directly with iter_chunks()
+    """
+
+    def __init__(self, tfc_client, url, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, max_resumes=5):
+        self.tfc_client = tfc_client
+        self.url = url
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+
+        self.chunks = None
+        self.buffer = bytearray()
+
+    def iter_chunks(self):
+        """ Yield the body from [offset] onwards, reconnecting where we left off if the connection drops """
+
+        resumes = 0
+        while True:
+            headers = {'Range': f"bytes={self.offset}-"} if self.offset else {}
+            try:
+                with self.tfc_client.get(self.url, stream=True, headers=headers) as response:
+                    # Asking for a range starting at the end of the file: we already have it all
+                    if response.status_code == 416 and self.offset:
+                        return
+                    response.raise_for_status()
+
+                    # The server may ignore the Range header and send everything again
+                    skip = self.offset if self.offset and response.status_code != 206 else 0
+
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk = chunk[dropped:]
+                            skip -= dropped
+                        if chunk:
+                            self.offset += len(chunk)
+                            yield chunk
+                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                resumes += 1
+                if resumes > self.max_resumes:
+                    raise
+                logging.warning(f"Download interrupted at byte {self.offset}, resuming ({resumes}/{self.max_resumes}): {e}")
+
+    def read(self, size=-1):
+        """ Return up to [size] bytes (everything left if negative), b'' at the end """
+
+        if self.chunks is None:
+            self.chunks = self.iter_chunks()
+
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer.extend(chunk)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        # Deleting from the front of a bytearray doesn't copy what's left
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
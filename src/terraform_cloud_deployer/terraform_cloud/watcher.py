@@ -0,0 +1,141 @@
+"""
+Following many runs at once
+
+Rather than polling each run (or its plan) separately, the runs being
+watched are grouped by workspace, and each poll reads the recent runs list of
+every workspace with runs still in progress. The number of requests then
+grows with the number of workspaces, however many runs are watched in each
+
+https://developer.hashicorp.com/terraform/cloud-docs/api-docs/run#list-runs-in-a-workspace
+"""
+
+import collections
+import logging
+import sys
+import requests
+
+from terraform_cloud_deployer.terraform_cloud.json_backend import decode
+from terraform_cloud_deployer.terraform_cloud.polling import Poller
+
+# Runs in these states won't change again
+FINISHED_STATUSES = ['applied', 'planned_and_finished', 'planned_and_saved', 'errored', 'discarded', 'canceled', 'force_canceled']
+
+# Finished, but not the way anyone wanted
+FAILED_STATUSES = ['errored', 'discarded', 'canceled', 'force_canceled']
+
+# Runs in these states won't change again until somebody does something about them
+WAITING_STATUSES = ['policy_override', 'policy_soft_failed']
+
+# Newest first, so one page is nearly always enough to find every run being watched
+RUNS_PAGE_SIZE = 100
+
+class Watcher():
+    """ Watches runs across any number of workspaces, reporting each change of status """
+
+    def __init__(self, tfc_client, poller=None):
+        self.tfc_client = tfc_client
+        self.tfc_root_url = tfc_client.tfc_root_url
+        self.poller = poller or Poller()
+
+        # {workspace ID: {run ID: run}} for the runs still in progress
+        self.pending = collections.defaultdict(dict)
+        self.runs = {}
+
+    def add(self, run_id, workspace_id=None):
+        """
+        Start watching [run_id]. Without [workspace_id] the run is looked up
+        once to find it, which also gives its current status
+        """
+
+        if workspace_id is None:
+            try:
+                response = self.tfc_client.get(f"{self.tfc_root_url}/runs/{run_id}",
+                                               params={'fields[runs]': 'status,actions,workspace'})
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                print(f"Error getting run {run_id}:\n{e}")
+                sys.exit(1)
+            this_run = decode(response)['data']
+            workspace_id = this_run['relationships']['workspace']['data']['id']
+        else:
+            this_run = {'id': run_id, 'attributes': {'status': None}}
+
+        self.runs[run_id] = this_run
+        self.pending[workspace_id][run_id] = this_run
+
+    def watch(self):
+        """
+        Yield (run ID, previous status, status) each time a run changes state,
+        starting with the status each run is in now, until every run has
+        settled or the poller's deadline passes. Check self.pending after to
+        see which runs never settled
+        """
+
+        for run_id, this_run in self.runs.items():
+            if this_run['attributes']['status'] is not None:
+                yield run_id, None, this_run['attributes']['status']
+        self.drop_settled()
+
+        for _ in self.poller.attempts():
+            if not self.pending:
+                return
+
+            for workspace_id in list(self.pending):
+                for this_run in self.fetch_workspace_runs(workspace_id):
+                    run_id = this_run['id']
+                    previous_status = self.runs[run_id]['attributes']['status']
+                    self.runs[run_id] = self.pending[workspace_id][run_id] = this_run
+                    if this_run['attributes']['status'] != previous_status:
+                        yield run_id, previous_status, this_run['attributes']['status']
+
+            self.drop_settled()
+            if self.pending:
+                logging.info(f"Still waiting on {sum(len(runs) for runs in self.pending.values())} runs in {len(self.pending)} workspaces")
+
+    def fetch_workspace_runs(self, workspace_id):
+        """
+        Return the latest state of the pending runs in [workspace_id]. Pages
+        are only followed if a run has been pushed off the first one
+        """
+
+        wanted = set(self.pending[workspace_id])
+        found = []
+        params = {'page[size]': RUNS_PAGE_SIZE, 'page[number]': 1, 'fields[runs]': 'status,actions'}
+        while wanted and params['page[number]']:
+            try:
+                response = self.tfc_client.get(f"{self.tfc_root_url}/workspaces/{workspace_id}/runs", params=params)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                # Try again on the next poll
+                logging.warning(f"Could not list the runs in {workspace_id}: {e}")
+                break
+
+            response_json = decode(response)
+            for this_run in response_json.get('data', []):
+                if this_run['id'] in wanted:
+                    wanted.discard(this_run['id'])
+                    found.append(this_run)
+
+            params['page[number]'] = response_json.get('meta', {}).get('pagination', {}).get('next-page')
+
+        return found
+
+    def drop_settled(self):
+        """ Stop polling for runs which have settled, and for workspaces left with none """
+
+        for workspace_id in list(self.pending):
+            runs = self.pending[workspace_id]
+            for run_id in [run_id for run_id, this_run in runs.items() if is_settled(this_run)]:
+                del runs[run_id]
+            if not runs:
+                del self.pending[workspace_id]
+
+# Functions
+
+def is_settled(this_run):
+    """ True if [this_run] won't move on by itself: it's finished, or it's waiting on somebody """
+
+    attributes = this_run.get('attributes', {})
+    status = attributes.get('status')
+
+    return status in FINISHED_STATUSES or status in WAITING_STATUSES or bool((attributes.get('actions') or {}).get('is-confirmable'))
@@ -6,57 +6,85 @@ https://developer.hashicorp.com/terraform/cloud-docs/api-docs/state-versions
 
 import requests
 import json
+import os
+import gzip
+import codecs
+import tempfile
+import hashlib
+import fnmatch
+import datetime
+import collections
 from pprint import pprint
 import sys
 import re
 import time
 import logging
-import json
+from concurrent.futures import ThreadPoolExecutor
+from terraform_cloud_deployer.terraform_cloud import state_diff
+from terraform_cloud_deployer.terraform_cloud.json_backend import decode
+from terraform_cloud_deployer.terraform_cloud.json_stream import reindent
+from terraform_cloud_deployer.terraform_cloud.transfer import ResumableDownload, DEFAULT_CHUNK_SIZE
 
 class Workspace():
     """ Methods for interactive with workspaces """
 
-    def __init__(self, tfc_api_token, tfc_root_url, tfc_organisation):
-        self.tfc_api_token = tfc_api_token
-        self.tfc_root_url = tfc_root_url
+    def __init__(self, tfc_client, tfc_organisation, state_cache=None):
+        self.tfc_client = tfc_client
+        self.tfc_root_url = tfc_client.tfc_root_url
         self.tfc_organisation = tfc_organisation
+        self.state_cache = state_cache
+
+    def list_workspaces(self, concurrency=4):
+        """ Give a list of all workspace names """
+
+        return [this_workspace['attributes']['name'] for this_workspace in self.get_workspaces(concurrency, fields=['name'])]
 
-    def list_workspaces(self):
-        """ Give a list of all workspaces """
+    def get_workspaces(self, concurrency=4, fields=None):
+        """
+        Return every workspace in the organisation, with only the attributes
+        in [fields] if given. The first page tells us how many pages there
+        are, after which the rest are fetched [concurrency] at a time
+        """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
+        first_page = self.get_workspaces_page(1, fields)
+        total_pages = first_page['meta']['pagination']['total-pages']
 
-        next_page=1
-        workspace_names = []
-        while next_page:
-            try:
-                response = requests.get(
-                    f"{self.tfc_root_url}/organizations/{self.tfc_organisation}/workspaces?page[size]=100&page[number]={next_page}",
-                    headers=headers)
-            except requests.exceptions.HTTPError as e:
-                print(f"Error getting a list of workspaces:\n{e}")
-                sys.exit(1)
+        pages = [first_page]
+        if total_pages > 1:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                # map() hands results back in page order, whatever order they finish in
+                pages.extend(executor.map(lambda page_number: self.get_workspaces_page(page_number, fields), range(2, total_pages + 1)))
 
-            response_json = response.json()
-            [ workspace_names.append(this_name['attributes']['name']) for this_name in response_json['data']]
-            next_page = response_json['meta']['pagination']['next-page']
+        return [this_workspace for this_page in pages for this_workspace in this_page['data']]
 
-        return workspace_names
+    def get_workspaces_page(self, page_number, fields=None):
+        """ Return the decoded response for page [page_number] of the workspace listing """
+
+        params = {'fields[workspaces]': ','.join(fields)} if fields else None
+        try:
+            response = self.tfc_client.get(
+                f"{self.tfc_root_url}/organizations/{self.tfc_organisation}/workspaces?page[size]=100&page[number]={page_number}",
+                params=params)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"Error getting a list of workspaces:\n{e}")
+            sys.exit(1)
+
+        return decode(response)
 
     def list_states(self, tfc_workspace, version):
         """ Give a list of state versions """
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            response = requests.get(
+            response = self.tfc_client.get(
                 f"{self.tfc_root_url}/state-versions?filter[workspace][name]={tfc_workspace}&filter[organization][name]={self.tfc_organisation}&filter[status]=finalized",
-                headers=headers)
+                params={'fields[state-versions]': 'created-at'})
 
         except requests.exceptions.HTTPError as e:
             print(f"Error getting statefile:\n{e}")
             sys.exit(1)
 
-        response_json = response.json()
+        response_json = decode(response)
         try:
             state_ids = [ {this_item['attributes']['created-at']: this_item['id']} for this_item in response_json['data'] ]
         except KeyError:
@@ -67,43 +95,213 @@ class Workspace():
         return state_ids
 
     def get_workspace_id(self, tfc_workspace):
-        """ Return the workspace ID for [workspace] """
+        """ Return the workspace ID for [workspace], from the local cache if it's there """
+
+        workspace_id = self.tfc_client.workspace_cache.get(self.tfc_organisation, tfc_workspace)
+        if workspace_id:
+            return workspace_id
 
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            workspace_response = requests.get(f"{self.tfc_root_url}/organizations/{self.tfc_organisation}/workspaces/{tfc_workspace}", headers=headers)
+            workspace_response = self.tfc_client.get(f"{self.tfc_root_url}/organizations/{self.tfc_organisation}/workspaces/{tfc_workspace}",
+                                                     params={'fields[workspaces]': 'name'})
             workspace_response.raise_for_status()
         except requests.exceptions.HTTPError as e:
             print(f"Error getting information on workspace {tfc_workspace}. Does the token you're using have access to it?:\n{e}")
             sys.exit(1)
 
-        return workspace_response.json()['data']['id']
+        workspace_id = decode(workspace_response)['data']['id']
+        self.tfc_client.workspace_cache.set(self.tfc_organisation, tfc_workspace, workspace_id)
 
-    def get_state(self, tfc_workspace, version):
-        """ Get a statefile """
+        return workspace_id
 
+    def get_state_version(self, tfc_workspace, version):
+        """
+        Get the decoded response for state version [version], or the current
+        one for [tfc_workspace] if that's None. There's no 'data' when the
+        workspace has no state
+        """
         if version != None:
             state_url = f"{self.tfc_root_url}/state-versions/{version}"
         else:
             state_url = f"{self.tfc_root_url}/workspaces/{self.get_workspace_id(tfc_workspace)}/current-state-version"
-
-        headers = {'Authorization': f"Bearer {self.tfc_api_token}", 'Content-Type': 'application/vnd.api+json'}
         try:
-            response = requests.get(
-                state_url,
-                headers=headers)
+            response = self.tfc_client.get(state_url, params={'fields[state-versions]': 'hosted-state-download-url,status'})
         except requests.exceptions.HTTPError as e:
             print(f"Error getting statefile:\n{e}")
             sys.exit(1)
 
-        response_json = response.json()
+        return decode(response)
+
+    def iter_state(self, tfc_workspace, version):
+        """
+        Return (state version ID, chunks of the statefile), from the state
+        cache where possible. Asking for a [version] already in the cache
+        doesn't touch the network at all
+        """
+        if version != None and self.state_cache:
+            chunks = self.state_cache.get(version)
+            if chunks is not None:
+                return version, chunks
+
         try:
-            state_download_url = response_json['data']['attributes']['hosted-state-download-url']
+            state_version = self.get_state_version(tfc_workspace, version)['data']
+            state_download_url = state_version['attributes']['hosted-state-download-url']
         except KeyError:
             print(f"There was a problem getting the statefile for the workspace '{tfc_workspace}'. Are there any states to fetch?")
             sys.exit(1)
-        state_file = requests.get(state_download_url, headers=headers)
-        with open('downloaded-terraform.tfstate', 'w') as state_file_io:
-            state_file_io.write(json.dumps(state_file.json(), indent=2))
 
-        print("Wrote the statefile to 'downloaded-terraform.tfstate' in the current directory")
+        if not self.state_cache:
+            return state_version['id'], ResumableDownload(self.tfc_client, state_download_url).iter_chunks()
+
+        chunks = self.state_cache.get(state_version['id'])
+        if chunks is None:
+            chunks = ResumableDownload(self.tfc_client, state_download_url).iter_chunks()
+            # Older state versions have no status, and are always finalized
+            if state_version['attributes'].get('status', 'finalized') == 'finalized':
+                chunks = self.state_cache.store(state_version['id'], chunks)
+
+        return state_version['id'], chunks
+
+    def diff_states(self, old_version, new_version):
+        """ Print which resource instances were added, removed or changed between two state versions """
+
+        differences = state_diff.diff_states(lambda: self.iter_state(None, old_version)[1],
+                                             lambda: self.iter_state(None, new_version)[1])
+
+        print(f"{old_version} (serial {differences['old'].get('serial')}) -> {new_version} (serial {differences['new'].get('serial')})")
+        for address in differences['added']:
+            print(f"+ {address}")
+        for address in differences['removed']:
+            print(f"- {address}")
+        for address, paths in differences['changed'].items():
+            print(f"~ {address}: {', '.join(paths)}")
+        print(f"{len(differences['added'])} added, {len(differences['removed'])} removed, {len(differences['changed'])} changed")
+
+    def get_state(self, tfc_workspace, version, output='downloaded-terraform.tfstate', pretty=False, compress=False):
+        """
+        Stream a statefile to [output] without holding it in memory, optionally
+        re-indenting it ([pretty]) and gzipping it ([compress]) on the way
+        """
+        state_version_id, chunks = self.iter_state(tfc_workspace, version)
+        if pretty:
+            text = reindent(codecs.iterdecode(chunks, 'utf-8'))
+            chunks = (this_text.encode('utf-8') for this_text in text)
+
+        write_atomically(chunks, output, compress)
+
+        print(f"Wrote the statefile ({state_version_id}) to '{output}'")
+
+    def export_states(self, directory, pattern='*', concurrency=4):
+        """
+        Save the current statefile of every workspace whose name matches the
+        glob [pattern] under [directory], [concurrency] at a time, as
+        <workspace>/<state version>.tfstate. State versions already there are
+        not downloaded again. A manifest of what was saved, with SHA-256
+        checksums, is written to manifest.json in [directory]
+        """
+
+        workspaces = [this_workspace for this_workspace in self.get_workspaces(concurrency, fields=['name', 'current-state-version'])
+                      if fnmatch.fnmatchcase(this_workspace['attributes']['name'], pattern)]
+
+        manifest_path = os.path.join(directory, 'manifest.json')
+        try:
+            with open(manifest_path, 'r') as manifest_io:
+                previous_entries = {this_entry['workspace']: this_entry for this_entry in json.load(manifest_io)['workspaces']}
+        except (OSError, ValueError, KeyError):
+            previous_entries = {}
+
+        def export_one(this_workspace):
+            return self.export_state(this_workspace, directory, previous_entries.get(this_workspace['attributes']['name']))
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            entries = list(executor.map(export_one, workspaces))
+
+        manifest = {
+            'organisation': self.tfc_organisation,
+            'exported-at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'workspaces': entries
+        }
+        write_atomically([json.dumps(manifest, indent=2).encode('utf-8')], manifest_path)
+
+        counts = collections.Counter(this_entry['status'] for this_entry in entries)
+        print(f"Exported {len(entries)} workspaces to '{directory}': " + ', '.join(f"{count} {status}" for status, count in sorted(counts.items())))
+
+        return entries
+
+    def export_state(self, workspace, directory, previous_entry=None):
+        """
+        Save the current statefile of [workspace] (as it comes from the
+        workspace listing) under [directory], and return its manifest entry.
+        [previous_entry] is the entry from the last export, if there was one
+        """
+
+        name = workspace['attributes']['name']
+        entry = {'workspace': name, 'workspace-id': workspace['id'], 'status': 'no-state'}
+
+        # The listing already says which state version is current, so there's nothing to ask for if we have it
+        state_version = ((workspace.get('relationships') or {}).get('current-state-version') or {}).get('data')
+        if not state_version:
+            return entry
+
+        entry['state-version'] = state_version['id']
+        entry['path'] = os.path.join(name, f"{state_version['id']}.tfstate")
+        path = os.path.join(directory, entry['path'])
+
+        if os.path.exists(path):
+            entry['status'] = 'skipped'
+            entry['size'] = os.path.getsize(path)
+            if previous_entry and previous_entry.get('state-version') == state_version['id'] and previous_entry.get('size') == entry['size']:
+                entry['sha256'] = previous_entry['sha256']
+            else:
+                with open(path, 'rb') as state_io:
+                    digest = hashlib.sha256()
+                    for chunk in iter(lambda: state_io.read(DEFAULT_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                entry['sha256'] = digest.hexdigest()
+            return entry
+
+        try:
+            response = self.tfc_client.get(f"{self.tfc_root_url}/state-versions/{state_version['id']}",
+                                           params={'fields[state-versions]': 'hosted-state-download-url'})
+            response.raise_for_status()
+            state_download_url = decode(response)['data']['attributes']['hosted-state-download-url']
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            entry['sha256'], entry['size'] = write_atomically(ResumableDownload(self.tfc_client, state_download_url).iter_chunks(), path)
+            entry['status'] = 'downloaded'
+        except (requests.exceptions.RequestException, KeyError, OSError) as e:
+            logging.error(f"Could not export the statefile for '{name}': {e}")
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+
+        return entry
+
+# Functions
+
+def write_atomically(chunks, output, compress=False):
+    """
+    Write [chunks] to [output], gzipped if [compress]. Everything goes to a
+    temporary file alongside which is moved into place at the end, so a
+    failure never leaves half a file behind. Returns the SHA-256 (hex) and
+    size of what was in [chunks]
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+
+    output_directory = os.path.dirname(os.path.abspath(output))
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=output_directory, prefix='.tfstate-')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as raw_io:
+            output_io = gzip.GzipFile(fileobj=raw_io, mode='wb', mtime=0) if compress else raw_io
+            with output_io:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    output_io.write(chunk)
+        os.replace(temporary_path, output)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+    return digest.hexdigest(), size
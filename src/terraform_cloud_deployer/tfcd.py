@@ -1,32 +1,139 @@
 """
-Top level Terraform Cloud API CLI helper. See the commands imports inside for sub-commands
+Top level Terraform Cloud API CLI helper. See lazy_subcommands on main for the sub-commands
 """
 
 import logging
+import importlib
 import click
 import os
 import sys
 import json
 
-from terraform_cloud_deployer import __version__
-
 __author__ = "Afraz Ahmadzadeh"
 __copyright__ = "Afraz Ahmadzadeh"
 __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+class LazyGroup(click.Group):
+    """
+    Group whose [lazy_subcommands] ({name: 'module:attribute'}) are only
+    imported when they're run, or listed in --help
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(super().list_commands(ctx) + list(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_subcommands:
+            return super().get_command(ctx, cmd_name)
+
+        module_name, attribute = self.lazy_subcommands[cmd_name].split(':')
+        return getattr(importlib.import_module(module_name), attribute)
 
-@click.group()
+class LazyObject(dict):
+    """ Context object whose [factories] entries are only worked out when a command first asks for them """
+
+    def __init__(self, factories, **values):
+        super().__init__(**values)
+        self.factories = factories
+
+    def __missing__(self, key):
+        if key not in self.factories:
+            raise KeyError(key)
+
+        self[key] = self.factories[key]()
+        return self[key]
+
+@click.group(cls=LazyGroup, lazy_subcommands={
+    'configuration': 'terraform_cloud_deployer.terraform_cloud.commands:configuration',
+    'run': 'terraform_cloud_deployer.terraform_cloud.commands:run',
+    'workspace': 'terraform_cloud_deployer.terraform_cloud.commands:workspace',
+    'communication': 'terraform_cloud_deployer.communication.commands:communication'
+})
+@click.version_option(package_name='terraform-cloud-deployer', prog_name='tfcd')
 @click.pass_context
 @click.option("--tfc-organisation", '-o', default='guidion', help='Terraform Cloud organisation name')
 @click.option("--tfc-api-token", '-t', help='Terraform Cloud API token')
 @click.option("--tfc-workspace", '-w', help='DEPRECATED: Please use the -w option in the sub-commands', required=False)
-def main(ctx, tfc_organisation, tfc_api_token, tfc_workspace):
+@click.option("--http-pool-size", default=10, show_default=True, help='Number of keep-alive connections to hold open to Terraform Cloud')
+@click.option("--http-timeout", default=30.0, show_default=True, help='Seconds to wait on Terraform Cloud before giving up on a request')
+@click.option("--rate-limit", default=30.0, show_default=True, help='Most API requests to make per second. Terraform Cloud allows 30 per token')
+@click.option("--max-retries", default=5, show_default=True, help='How many times to retry a rate limited (429) request')
+@click.option("--workspace-cache-ttl", default=86400, show_default=True, help='Seconds to trust cached workspace IDs for. 0 disables the cache')
+@click.option("--state-cache-size", default=1024, show_default=True, help='Megabytes of downloaded statefiles to keep on disk. 0 disables the cache')
+@click.option("--poll-interval", default=1.0, show_default=True, help='Seconds to wait before the first re-check when waiting on Terraform Cloud')
+@click.option("--poll-max-interval", default=15.0, show_default=True, help='Longest to wait between re-checks, however long the wait gets')
+@click.option("--poll-timeout", default=900.0, show_default=True, help='Seconds to wait on plans and uploads before giving up')
+@click.option("--trace", 'trace_path', type=click.Path(dir_okay=False), help='Record the timings of every HTTP call to this file, as Chrome trace events')
+def main(ctx, tfc_organisation, tfc_api_token, tfc_workspace, http_pool_size, http_timeout, rate_limit, max_retries, workspace_cache_ttl,
+         state_cache_size, poll_interval, poll_max_interval, poll_timeout, trace_path):
     """
     Helper package for performing Terraform CI/CD operations. Also talks a bit to Slack ;)
     """
 
+    tfc_root_url = "https://app.terraform.io/api/v2"
+
+    tracer = None
+    if trace_path:
+        from terraform_cloud_deployer.tracing import Tracer
+        tracer = Tracer(trace_path, name=f"tfcd {ctx.invoked_subcommand}")
+        ctx.call_on_close(tracer.write)
+
+    def create_client():
+        from terraform_cloud_deployer.terraform_cloud.cache import WorkspaceCache
+        from terraform_cloud_deployer.terraform_cloud.client import Client
+        from terraform_cloud_deployer import daemon
+
+        api_token = ctx.obj['tfc_api_token']
+
+        def new_client():
+            return Client(api_token, tfc_root_url, pool_size=http_pool_size, timeout=http_timeout,
+                          workspace_cache=WorkspaceCache(ttl=workspace_cache_ttl), rate_limit=rate_limit, max_retries=max_retries,
+                          tracer=tracer)
+
+        if daemon.warm_clients is not None:
+            # Under 'tfcd serve', the same settings get the same client, connections and caches and all
+            tfc_client = daemon.warm_client((api_token, tfc_root_url, http_pool_size, http_timeout, workspace_cache_ttl, rate_limit, max_retries),
+                                            new_client)
+            # Only this command's calls go in this command's trace
+            tfc_client.tracer = tracer
+            return tfc_client
+
+        tfc_client = new_client()
+        ctx.call_on_close(tfc_client.close)
+        return tfc_client
+
+    def create_state_cache():
+        from terraform_cloud_deployer.terraform_cloud.cache import StateCache
+        return StateCache(max_size=state_cache_size * 1024 * 1024)
+
+    def create_poller():
+        from terraform_cloud_deployer.terraform_cloud.polling import Poller
+        return Poller(initial_interval=poll_interval, max_interval=poll_max_interval, timeout=poll_timeout)
+
+    # Nothing is looked up or connected to until a command actually needs it
+    ctx.obj = LazyObject({
+            'tfc_api_token': lambda: resolve_token(tfc_api_token),
+            'tfc_client': create_client,
+            'tfc_state_cache': create_state_cache,
+            'tfc_poller': create_poller
+        },
+        tfc_organisation=tfc_organisation,
+        tfc_workspace=tfc_workspace,
+        tfc_root_url=tfc_root_url,
+        tracer=tracer)
+
+def resolve_token(tfc_api_token):
+    """
+    Return [tfc_api_token] if given, else the token from the environment, else
+    the one from Terraform's own credentials file. Exits if there's none
+    """
+
     try:
         tfc_api_token = tfc_api_token or os.environ['TF_TOKEN_app_terraform_io']
     except KeyError as e:
@@ -43,18 +150,18 @@ def main(ctx, tfc_organisation, tfc_api_token, tfc_workspace):
         print("Please ensure that either the environment variable TF_TOKEN_app_terraform_io is set, or you pass it in with the -t flag, or you have a valid configuration file in '~/.terraform.d'")
         sys.exit(1)
 
-    ctx.obj = {
-        'tfc_api_token': tfc_api_token,
-        'tfc_organisation': tfc_organisation,
-        'tfc_workspace': tfc_workspace,
-        'tfc_root_url': "https://app.terraform.io/api/v2"
-    }
-
-from terraform_cloud_deployer.terraform_cloud.commands import configuration as configuration_commands
-from terraform_cloud_deployer.terraform_cloud.commands import run as run_commands
-from terraform_cloud_deployer.terraform_cloud.commands import workspace as workspace_commands
-from terraform_cloud_deployer.communication.commands import communication as communication_commands
-main.add_command(configuration_commands)
-main.add_command(run_commands)
-main.add_command(workspace_commands)
-main.add_command(communication_commands)
+    return tfc_api_token
+
+@main.command()
+@click.option("--socket", 'socket_path', help='Unix socket to listen on. Defaults to $TFCD_SOCKET, or tfcd.sock in $XDG_RUNTIME_DIR, or in a private tfcd-<uid> directory in /tmp')
+@click.option("--idle-timeout", default=3600, show_default=True, help='Stop after this many seconds without a command. 0 never stops')
+def serve(socket_path, idle_timeout):
+    """
+    Keep a tfcd process running, with its connections and caches warm.
+    Other tfcd calls hand their commands over to it rather than starting from scratch
+    """
+
+    from terraform_cloud_deployer import daemon
+    if socket_path:
+        os.environ['TFCD_SOCKET'] = socket_path
+    daemon.serve(daemon.socket_path(), idle_timeout)
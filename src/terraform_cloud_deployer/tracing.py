@@ -0,0 +1,124 @@
+"""
+Timing of every HTTP call tfcd makes, for viewing as a waterfall
+
+With --trace FILE, each call to Terraform Cloud (and Slack) is recorded with
+its method, endpoint, status, size, DNS/connect/time to first byte/total
+times and how often it was retried. The file is in Chrome's trace event
+format, which chrome://tracing, Perfetto (https://ui.perfetto.dev) and
+speedscope all open.
+
+Timestamps are wall clock times, and calls are added to FILE if it's already
+a trace, so every tfcd step of a pipeline can share one and be seen together
+
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Terraform Cloud IDs are a type prefix and 16 letters and digits, e.g. run-CZcmD7eagjhyX0vN
+TFC_ID = re.compile('/([a-z]+)-[A-Za-z0-9]{16}(?=/|$)')
+
+class Tracer():
+    """
+    Collects timed HTTP calls from any thread, and writes them to [path] as
+    trace events, under one for the whole command called [name]
+    """
+
+    def __init__(self, path, name='tfcd'):
+        self.path = path
+        self.name = name
+        self.events = []
+        self.lock = threading.Lock()
+
+        self.pid = os.getpid()
+        # perf_counter() is what calls are timed with; this turns those times into wall clock ones
+        self.clock_offset = time.time() - time.perf_counter()
+        self.started = time.perf_counter()
+
+    def record(self, name, started, finished, category='http', **args):
+        """ Add a call called [name] which ran from [started] until [finished] (perf_counter() times), described by [args] """
+
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((started + self.clock_offset) * 1_000_000),
+            'dur': round((finished - started) * 1_000_000),
+            'pid': self.pid,
+            'tid': threading.get_ident(),
+            'args': args
+        }
+
+        with self.lock:
+            self.events.append(event)
+
+    def record_request(self, method, endpoint, started, finished, status=None, request_bytes=None, response_bytes=None,
+                       dns=None, connect=None, ttfb=None, retries=0, error=None):
+        """ Add an HTTP call, with its times (all in seconds) given in milliseconds as Chrome shows them """
+
+        self.record(f"{method} {endpoint}", started, finished,
+                    method=method,
+                    endpoint=endpoint,
+                    status=status,
+                    request_bytes=request_bytes,
+                    response_bytes=response_bytes,
+                    dns_ms=milliseconds(dns),
+                    connect_ms=milliseconds(connect),
+                    ttfb_ms=milliseconds(ttfb),
+                    total_ms=milliseconds(finished - started),
+                    retries=retries,
+                    error=error)
+
+    def write(self):
+        """ Write everything recorded to the trace file, after the calls already in it """
+
+        self.record(self.name, self.started, time.perf_counter(), category='command')
+
+        events = []
+        try:
+            with open(self.path, 'r') as trace_io:
+                events = json.load(trace_io).get('traceEvents', [])
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        with self.lock:
+            events += self.events
+
+        output_directory = os.path.dirname(os.path.abspath(self.path))
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=output_directory, prefix='.trace-')
+        try:
+            with os.fdopen(file_descriptor, 'w') as trace_io:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_io)
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+# Functions
+
+def endpoint_template(url, tfc_root_url):
+    """
+    The endpoint [url] is a call to, with the IDs and names taken out so that
+    calls to the same endpoint group together. Anything outside the API (like
+    signed download links) is just its host
+    """
+
+    url = url.split('?')[0]
+    if not url.startswith(tfc_root_url):
+        return re.sub('^(https?://[^/]+).*$', '\\1/...', url)
+
+    path = url[len(tfc_root_url):]
+    path = re.sub('^/organizations/[^/]+', '/organizations/{organization}', path)
+    path = re.sub('^(/organizations/{organization}/workspaces)/[^/]+', '\\1/{workspace}', path)
+
+    return TFC_ID.sub('/{\\1-id}', path)
+
+def milliseconds(seconds):
+    """ [seconds] in milliseconds, to the microsecond, or None if it's not known """
+
+    return None if seconds is None else round(seconds * 1000, 3)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from terraform_cloud_deployer.terraform_cloud.cache import ConfigurationCache, StateCache, WorkspaceCache
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def unwritable_cache(tmp_path, monkeypatch):
+    """A cache directory that can never be created, like one under HOME=/dev/null"""
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setenv("TFCD_CACHE_DIR", str(blocker / "tfcd"))
+    return blocker
+
+
+@pytest.fixture
+def cache_directory(tmp_path, monkeypatch):
+    directory = tmp_path / "cache"
+    monkeypatch.setenv("TFCD_CACHE_DIR", str(directory))
+    return directory
+
+
+def test_nothing_created_until_needed(cache_directory):
+    WorkspaceCache()
+    ConfigurationCache()
+    StateCache()
+    assert not cache_directory.exists()
+
+
+def test_unwritable_caches_miss(unwritable_cache):
+    """The caches still work, they just never remember anything"""
+    workspace_cache = WorkspaceCache()
+    workspace_cache.set("org", "name", "ws-1")
+    assert WorkspaceCache().get("org", "name") is None
+
+    configuration_cache = ConfigurationCache()
+    configuration_cache.set("ws-1", "hash", "cv-1")
+    assert ConfigurationCache().get("ws-1", "hash") is None
+
+    state_cache = StateCache()
+    assert list(state_cache.store("sv-1", [b"a", b"b"])) == [b"a", b"b"]
+    assert state_cache.get("sv-1") is None
+
+
+def test_turned_off_caches_leave_disk_alone(cache_directory):
+    workspace_cache = WorkspaceCache(ttl=0)
+    workspace_cache.set("org", "name", "ws-1")
+    workspace_cache.invalidate("ws-1")
+    assert workspace_cache.get("org", "name") is None
+
+    state_cache = StateCache(max_size=0)
+    assert list(state_cache.store("sv-1", [b"a"])) == [b"a"]
+    assert not cache_directory.exists()
+
+
+def test_state_cache_round_trip(cache_directory):
+    state_cache = StateCache(chunk_size=2)
+    assert list(state_cache.store("sv-1", [b"abc", b"de"])) == [b"abc", b"de"]
+    assert b"".join(state_cache.get("sv-1")) == b"abcde"
+    assert os.listdir(cache_directory / "states") == ["sv-1.tfstate"]
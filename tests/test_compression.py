@@ -0,0 +1,72 @@
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from terraform_cloud_deployer.terraform_cloud.compression import ParallelGzipWriter
+from terraform_cloud_deployer.terraform_cloud.configuration import package_configuration
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+BLOCK_SIZE = 1024
+
+
+def data(size):
+    """[size] bytes, half random and half compressible"""
+    return os.urandom(size // 2) + b"tfcd" * (size // 8) + b"x" * (size - size // 2 - size // 8 * 4)
+
+
+@pytest.mark.parametrize(
+    "size", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 3 * BLOCK_SIZE, 20 * BLOCK_SIZE + 7]
+)
+@pytest.mark.parametrize("write_size", [1, 100, BLOCK_SIZE, 10 * BLOCK_SIZE])
+def test_round_trip(size, write_size):
+    """Whatever the block boundaries, the members decompress back to the input, in order"""
+    original = data(size)
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, workers=3, block_size=BLOCK_SIZE) as writer:
+        for start in range(0, size, write_size):
+            writer.write(original[start:start + write_size])
+
+    assert gzip.decompress(output.getvalue()) == original
+
+
+def test_output_is_repeatable():
+    original = data(10 * BLOCK_SIZE)
+    outputs = []
+    for _ in range(2):
+        output = io.BytesIO()
+        with ParallelGzipWriter(output, workers=4, block_size=BLOCK_SIZE) as writer:
+            writer.write(original)
+        outputs.append(output.getvalue())
+
+    assert outputs[0] == outputs[1]
+
+
+def test_close_twice():
+    output = io.BytesIO()
+    writer = ParallelGzipWriter(output, block_size=BLOCK_SIZE)
+    writer.write(b"abc")
+    writer.close()
+    writer.close()
+    assert gzip.decompress(output.getvalue()) == b"abc"
+
+
+def test_package_configuration_parallel(tmp_path):
+    """A tar.gz packaged on several cores reads back with tarfile"""
+    contents = {"main.tf": data(100), "big.bin": data(3 * 1024 * 1024 + 5), "empty.txt": b""}
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+
+    output = io.BytesIO()
+    paths = [str(tmp_path / name) for name in contents]
+    package_configuration(None, None, paths, output, compression_workers=4)
+
+    with tarfile.open(fileobj=io.BytesIO(output.getvalue()), mode="r:gz") as tar_file:
+        for name, content in contents.items():
+            member = tar_file.extractfile(str(tmp_path / name).lstrip(os.sep))
+            assert member.read() == content
@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+from terraform_cloud_deployer.terraform_cloud.configuration import configuration_paths
+from terraform_cloud_deployer.terraform_cloud.ignore import DEFAULT_RULES, IgnoreRules
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+
+def make_tree(root, paths):
+    """Create the files (and directories ending in /) [paths] under [root]"""
+    for path in paths:
+        full_path = os.path.join(root, path)
+        if path.endswith("/"):
+            os.makedirs(full_path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "w") as file_io:
+                file_io.write(path)
+
+
+def relative_paths(root, paths):
+    return sorted(os.path.relpath(path, root) for path in paths)
+
+
+@pytest.mark.parametrize(
+    "path, is_directory, verdict",
+    [
+        (".terraform", True, True),
+        (".terraform/modules", True, False),
+        (".git", True, True),
+        ("lambdas/.git", True, True),
+        # Only directories are matched by a trailing slash
+        (".terraform", False, None),
+        ("main.tf", False, None),
+    ],
+)
+def test_default_rules(path, is_directory, verdict):
+    """Terraform's own defaults"""
+    assert IgnoreRules(DEFAULT_RULES).match(path, is_directory) is verdict
+
+
+@pytest.mark.parametrize(
+    "pattern, path, verdict",
+    [
+        ("*.zip", "a.zip", True),
+        ("*.zip", "deep/down/a.zip", True),
+        ("/build", "build", True),
+        ("/build", "src/build", None),
+        ("docs/*.md", "docs/a.md", True),
+        ("docs/*.md", "docs/more/a.md", None),
+        ("**/tmp", "a/b/tmp", True),
+        ("logs/**", "logs/a/b.log", True),
+        ("a/**/z", "a/z", True),
+        ("a/**/z", "a/b/c/z", True),
+        ("file?.txt", "file1.txt", True),
+        ("file[!0-9].txt", "file1.txt", None),
+        ("# comment", "# comment", None),
+    ],
+)
+def test_patterns(pattern, path, verdict):
+    """gitignore style wildcards and anchoring"""
+    assert IgnoreRules([pattern]).match(path, False) is verdict
+
+
+def test_last_rule_wins():
+    rules = IgnoreRules(["*.log", "!keep.log", "keep.log"])
+    assert rules.match("keep.log", False) is True
+    assert IgnoreRules(["*.log", "!keep.log"]).match("keep.log", False) is False
+
+
+def test_may_include_under():
+    """Excluded directories are only walked if a negation could reach inside them"""
+    rules = IgnoreRules(["vendor/", "!vendor/keep/", "cache/"])
+    assert rules.may_include_under("vendor")
+    assert not rules.may_include_under("cache")
+    assert IgnoreRules(["cache/", "!*.keep"]).may_include_under("cache")
+
+
+def test_configuration_paths_defaults(tmp_path):
+    """.terraform/ is left out, apart from .terraform/modules/"""
+    make_tree(tmp_path, ["main.tf", ".terraform/providers/p", ".terraform/modules/m/main.tf", ".git/HEAD", "lambda/app.py"])
+    paths = configuration_paths(str(tmp_path), str(tmp_path))
+    assert relative_paths(tmp_path, paths) == sorted(
+        [".", ".terraform/modules", ".terraform/modules/m", ".terraform/modules/m/main.tf",
+         "lambda", "lambda/app.py", "main.tf"]
+    )
+
+
+def test_configuration_paths_negation(tmp_path):
+    """A negation brings back a file inside an excluded directory"""
+    make_tree(tmp_path, ["main.tf", "vendor/a.py", "vendor/keep/b.py", "build/out.bin"])
+    with open(tmp_path / ".terraformignore", "w") as ignore_io:
+        ignore_io.write("# Leave these out\nvendor/*\n!vendor/keep/\nbuild/\n")
+    paths = configuration_paths(str(tmp_path), str(tmp_path))
+    assert relative_paths(tmp_path, paths) == sorted(
+        [".", ".terraformignore", "main.tf", "vendor", "vendor/keep", "vendor/keep/b.py"]
+    )
+
+
+def test_configuration_paths_negation_under_excluded_directory(tmp_path):
+    """An excluded directory is still walked when a negation reaches inside it"""
+    make_tree(tmp_path, ["main.tf", "vendor/a.py", "vendor/keep/b.py"])
+    with open(tmp_path / ".terraformignore", "w") as ignore_io:
+        ignore_io.write("vendor/\n!vendor/keep/\n")
+    paths = configuration_paths(str(tmp_path), str(tmp_path))
+    assert relative_paths(tmp_path, paths) == sorted(
+        [".", ".terraformignore", "main.tf", "vendor/keep", "vendor/keep/b.py"]
+    )
+
+
+def test_configuration_paths_excludes(tmp_path):
+    """Extra patterns go on top of .terraformignore"""
+    make_tree(tmp_path, ["main.tf", "a.zip", "tests/test_a.py"])
+    paths = configuration_paths(str(tmp_path), str(tmp_path), excludes=["*.zip", "tests/"])
+    assert relative_paths(tmp_path, paths) == [".", "main.tf"]
+
+
+def test_configuration_paths_code_outside(tmp_path):
+    """A code directory outside the Terraform one is still filtered by its rules, and the .tf files come after it"""
+    terraform_directory = tmp_path / "terraform"
+    code_directory = tmp_path / "lambdas"
+    make_tree(terraform_directory, ["main.tf", "variables.tf", "notes.txt"])
+    make_tree(code_directory, ["app.py", "bundle.zip", ".git/HEAD", "lib/util.py"])
+    with open(terraform_directory / ".terraformignore", "w") as ignore_io:
+        ignore_io.write("*.zip\n")
+
+    paths = configuration_paths(str(terraform_directory), str(code_directory))
+    assert relative_paths(tmp_path, paths) == [
+        "lambdas", "lambdas/app.py", "lambdas/lib", "lambdas/lib/util.py", "terraform/main.tf", "terraform/variables.tf"
+    ]
+    assert relative_paths(tmp_path, paths[-2:]) == ["terraform/main.tf", "terraform/variables.tf"]
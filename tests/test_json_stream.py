@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from terraform_cloud_deployer.terraform_cloud.json_stream import iter_array, reindent
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+PLAN = {
+    "format_version": "1.2",
+    "applyable": True,
+    "variables": {"name": {"value": 'quote " and backslash \\ and brace }'}},
+    "prior_state": {"values": [1, [2, {"3": "]"}], "é漢"]},
+    "resource_changes": [
+        {"address": "aws_s3_bucket.a", "change": {"actions": ["create"], "after": {"tags": {}}}},
+        {"address": 'null_resource.b["k\\"ey"]', "change": {"actions": ["delete"], "before": -2500.0}},
+        {"address": "aws_iam_role.c", "change": {"actions": ["no-op"], "after": [None, False, 1e-07]}},
+        [],
+        "\t\n\\u0041",
+        -12,
+    ],
+    "errored": False,
+}
+
+
+def split(text, size):
+    """Chunks of [text], [size] characters at a time"""
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100000])
+def test_iter_array(size):
+    """Elements come out whole, however the text is split up"""
+    scalars = {}
+    elements = list(iter_array(split(json.dumps(PLAN), size), "resource_changes", scalars))
+    assert elements == PLAN["resource_changes"]
+    assert scalars == {"format_version": "1.2", "applyable": True}
+
+
+@pytest.mark.parametrize("size", [1, 5])
+def test_iter_array_spacing(size):
+    """Whitespace anywhere between tokens makes no difference"""
+    text = json.dumps(PLAN, indent=4).replace(":", " :\n").replace(",", "\t,")
+    assert list(iter_array(split(text, size), "resource_changes")) == PLAN["resource_changes"]
+
+
+def test_iter_array_escapes_across_chunks():
+    """A backslash at the end of one chunk escapes the first character of the next"""
+    text = '{"skipped": "a\\"b\\\\", "key\\"": ["x\\"y", "\\\\"]}'
+    chunks = split(text, 1)
+    assert list(iter_array(chunks, 'key"')) == ['x"y', "\\"]
+
+
+def test_iter_array_missing_key():
+    """A KeyError if the array isn't there"""
+    with pytest.raises(KeyError):
+        list(iter_array(split(json.dumps(PLAN), 3), "output_changes"))
+
+
+def test_iter_array_stops_reading():
+    """The rest of the document isn't read once the array is done with"""
+    text = json.dumps(dict(PLAN, output_changes="x" * 100000))
+    read = []
+
+    def chunks():
+        for chunk in split(text, 10):
+            read.append(chunk)
+            yield chunk
+
+    list(iter_array(chunks(), "resource_changes"))
+    assert len("".join(read)) < len(text) / 2
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100000])
+def test_reindent(size):
+    """Output is exactly what json.dumps(indent=2) would give"""
+    text = "".join(reindent(split(json.dumps(PLAN), size)))
+    assert text == json.dumps(PLAN, indent=2)
+
+
+def test_reindent_already_indented():
+    """Existing layout is thrown away"""
+    text = "".join(reindent(split(json.dumps(PLAN, indent=7), 5)))
+    assert text == json.dumps(PLAN, indent=2)
+
+
+@pytest.mark.parametrize("document", [{}, [], "\\", 12.5, {"a": [[], {}]}])
+def test_reindent_small(document):
+    """Empty containers and bare scalars"""
+    assert "".join(reindent(split(json.dumps(document), 1))) == json.dumps(document, indent=2)
@@ -0,0 +1,119 @@
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+from terraform_cloud_deployer.terraform_cloud.client import Client
+from terraform_cloud_deployer.terraform_cloud.rate_limit import TokenBucket, retry_after
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers the first [throttle] requests with a 429 and Retry-After, and 200 after that"""
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests <= self.server.throttle:
+            self.send_response(429)
+            self.send_header("Retry-After", self.server.retry_after)
+            body = b'{"errors": [{"status": "429"}]}'
+        else:
+            self.send_response(200)
+            body = b'{"data": []}'
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *arguments):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv("TFCD_CACHE_DIR", str(tmp_path))
+    this_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    this_server.requests = 0
+    this_server.throttle = 0
+    this_server.retry_after = "0"
+    threading.Thread(target=this_server.serve_forever, args=(0.05,), daemon=True).start()
+    yield this_server
+    this_server.shutdown()
+    this_server.server_close()
+
+
+def client(server, **kwargs):
+    return Client("token", f"http://127.0.0.1:{server.server_port}/api/v2", timeout=5, **kwargs)
+
+
+def test_429_retried(server):
+    server.throttle = 2
+    server.retry_after = "0.2"
+    started = time.monotonic()
+    response = client(server, max_retries=3).get(f"http://127.0.0.1:{server.server_port}/api/v2/runs")
+    assert response.status_code == 200
+    assert server.requests == 3
+    # Retry-After was waited out each time
+    assert time.monotonic() - started >= 0.4
+
+
+def test_429_gives_up(server):
+    server.throttle = 100
+    with pytest.raises(requests.exceptions.HTTPError) as error:
+        client(server, max_retries=2).get(f"http://127.0.0.1:{server.server_port}/api/v2/runs")
+    assert error.value.response.status_code == 429
+    assert server.requests == 3
+
+
+@pytest.mark.parametrize(
+    "headers, seconds",
+    [
+        ({"Retry-After": "3"}, 3),
+        ({"Retry-After": "0.5", "X-RateLimit-Reset": "9"}, 0.5),
+        ({"X-RateLimit-Reset": "0.25"}, 0.25),
+        ({"Retry-After": "-1"}, 0),
+        ({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 1),
+        ({}, 1),
+    ],
+)
+def test_retry_after(headers, seconds):
+    response = requests.Response()
+    response.headers.update(headers)
+    assert retry_after(response) == seconds
+
+
+def test_bucket_rate():
+    """A full bucket lets [rate] calls straight through, then refills at [rate] a second"""
+    bucket = TokenBucket(20)
+    started = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    assert 0.4 <= time.monotonic() - started < 1.0
+
+
+def test_bucket_block_for():
+    bucket = TokenBucket(1000)
+    started = time.monotonic()
+    bucket.block_for(0.2)
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.2
+
+
+def test_bucket_update():
+    """The rate limit headers can only slow the bucket down"""
+    bucket = TokenBucket(30)
+    bucket.update({"X-RateLimit-Limit": "10", "X-RateLimit-Remaining": "2"})
+    assert bucket.rate == 10
+    assert bucket.tokens <= 2
+
+    bucket.update({"X-RateLimit-Limit": "50", "X-RateLimit-Remaining": "junk"})
+    assert bucket.rate == 10
+
+    started = time.monotonic()
+    bucket.update({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0.2"})
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.2
@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+# Modules only the commands that talk to Terraform Cloud or Slack should pay for
+HEAVY_MODULES = ["requests", "slack_sdk", "tarfile"]
+
+# Generous, so slow CI machines pass, but well short of importing everything
+STARTUP_BUDGET = 1.0
+
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+sys.argv = ['tfcd'] + sys.argv[1:]
+from terraform_cloud_deployer.daemon import run
+try:
+    run()
+except SystemExit as e:
+    exit_code = e.code
+print(json.dumps({
+    'exit': exit_code,
+    'seconds': time.perf_counter() - started,
+    'heavy': [name for name in %r if name in sys.modules]
+}), file=sys.stderr)
+""" % (HEAVY_MODULES,)
+
+
+def start_tfcd(*arguments):
+    """Run tfcd [arguments] in a fresh interpreter, with no credentials or server to find"""
+    environment = dict(os.environ, HOME=os.devnull, TFCD_NO_DAEMON="1")
+    environment.pop("TF_TOKEN_app_terraform_io", None)
+    completed = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT, *arguments],
+        env=environment,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    return completed.stdout, json.loads(completed.stderr.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize(
+    "arguments", [["--help"], ["--version"], ["run", "--help"], ["workspace", "--help"]]
+)
+def test_startup(arguments):
+    """Help and version need no credentials, and import nothing heavy"""
+    output, report = start_tfcd(*arguments)
+    assert report["exit"] == 0
+    assert report["heavy"] == []
+    assert report["seconds"] < STARTUP_BUDGET
+
+
+def test_credentials_deferred():
+    """Credentials are only looked for once a command needs the API"""
+    output, report = start_tfcd("workspace", "list-workspaces")
+    assert report["exit"] == 1
+    assert "TF_TOKEN_app_terraform_io" in output
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from terraform_cloud_deployer.terraform_cloud.state_diff import (
+    changed_paths,
+    diff_states,
+    hash_attributes,
+    index_state,
+    instance_address,
+)
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+
+def resource(type, name, instances, mode="managed", module=None):
+    this_resource = {"mode": mode, "type": type, "name": name, "instances": instances}
+    if module:
+        this_resource["module"] = module
+    return this_resource
+
+
+def statefile(*resources, serial=1):
+    """The chunks of a statefile holding [resources], a few bytes at a time"""
+    text = json.dumps({"version": 4, "serial": serial, "lineage": "abc", "resources": list(resources)})
+    data = text.encode("utf-8")
+    return [data[start:start + 7] for start in range(0, len(data), 7)]
+
+
+@pytest.mark.parametrize(
+    "this_resource, instance, address",
+    [
+        (resource("aws_s3_bucket", "a", []), {}, "aws_s3_bucket.a"),
+        (resource("aws_s3_bucket", "a", []), {"index_key": 0}, "aws_s3_bucket.a[0]"),
+        (resource("aws_s3_bucket", "a", []), {"index_key": 'k"y'}, 'aws_s3_bucket.a["k\\"y"]'),
+        (resource("aws_ami", "a", [], mode="data"), {}, "data.aws_ami.a"),
+        (resource("aws_ami", "a", [], mode="data", module="module.x"), {"index_key": "b"}, 'module.x.data.aws_ami.a["b"]'),
+        (resource("aws_s3_bucket", "a", [], module='module.x["y"].module.z'), {}, 'module.x["y"].module.z.aws_s3_bucket.a'),
+        (resource("aws_instance", "a", []), {"index_key": 1, "deposed": "1a2b3c4d"}, "aws_instance.a[1] (deposed object 1a2b3c4d)"),
+    ],
+)
+def test_instance_address(this_resource, instance, address):
+    assert instance_address(this_resource, instance) == address
+
+
+def test_hash_ignores_key_order():
+    first = {"attributes": {"a": 1, "b": {"c": [1, 2], "d": None}}}
+    second = {"attributes": {"b": {"d": None, "c": [1, 2]}, "a": 1}}
+    assert hash_attributes(first) == hash_attributes(second)
+    assert hash_attributes(first) != hash_attributes({"attributes": {"a": 1, "b": {"c": [2, 1], "d": None}}})
+
+
+def test_index_state():
+    scalars = {}
+    index = index_state(statefile(
+        resource("aws_s3_bucket", "a", [{"index_key": "x", "attributes": {"id": 1}}, {"index_key": "y", "attributes": {"id": 2}}]),
+        resource("aws_instance", "b", [{"attributes": {"id": 3}}, {"deposed": "00000001", "attributes": {"id": 4}}]),
+    ), scalars)
+    assert sorted(index) == [
+        "aws_instance.b", "aws_instance.b (deposed object 00000001)", 'aws_s3_bucket.a["x"]', 'aws_s3_bucket.a["y"]'
+    ]
+    assert index["aws_instance.b"] != index["aws_instance.b (deposed object 00000001)"]
+    assert scalars == {"version": 4, "serial": 1, "lineage": "abc"}
+
+
+@pytest.mark.parametrize(
+    "old, new, paths",
+    [
+        ({"tags": {"Name": "a"}}, {"tags": {"Name": "b"}}, ["tags.Name"]),
+        ({"tags": {}}, {"tags": {"Name": "b"}}, ["tags.Name"]),
+        ({"ingress": [{"cidr": "a", "port": 1}]}, {"ingress": [{"cidr": "b", "port": 1}]}, ["ingress[0].cidr"]),
+        ({"ingress": [1]}, {"ingress": [1, 2]}, ["ingress"]),
+        ({"a": 1, "b": 2}, {"a": 2, "b": 3}, ["a", "b"]),
+        (None, {"a": 1}, ["(everything)"]),
+    ],
+)
+def test_changed_paths(old, new, paths):
+    assert list(changed_paths(old, new)) == paths
+
+
+def test_diff_states():
+    old = statefile(
+        resource("aws_s3_bucket", "kept", [{"index_key": 0, "attributes": {"id": "k", "tags": {"a": 1, "b": 2}}}]),
+        resource("aws_s3_bucket", "changed", [{"attributes": {"id": "c", "tags": {"Name": "old"}}}]),
+        resource("aws_s3_bucket", "removed", [{"attributes": {"id": "r"}}], module="module.m"),
+    )
+    new = statefile(
+        resource("aws_s3_bucket", "added", [{"index_key": "x", "attributes": {"id": "a"}}]),
+        resource("aws_s3_bucket", "changed", [{"attributes": {"tags": {"Name": "new"}, "id": "c"}}]),
+        # Same attributes in another order
+        resource("aws_s3_bucket", "kept", [{"index_key": 0, "attributes": {"tags": {"b": 2, "a": 1}, "id": "k"}}]),
+        serial=2,
+    )
+
+    differences = diff_states(lambda: iter(old), lambda: iter(new))
+    assert differences["added"] == ['aws_s3_bucket.added["x"]']
+    assert differences["removed"] == ["module.m.aws_s3_bucket.removed"]
+    assert differences["changed"] == {"aws_s3_bucket.changed": ["tags.Name"]}
+    assert differences["old"]["serial"] == 1
+    assert differences["new"]["serial"] == 2
+
+
+def test_diff_states_deposed():
+    """A deposed object going away is a removal, not a change to the instance that replaced it"""
+    old = statefile(resource("aws_instance", "a", [{"attributes": {"id": "new"}}, {"deposed": "1a2b3c4d", "attributes": {"id": "old"}}]))
+    new = statefile(resource("aws_instance", "a", [{"attributes": {"id": "new"}}]))
+
+    differences = diff_states(lambda: iter(old), lambda: iter(new))
+    assert differences["removed"] == ["aws_instance.a (deposed object 1a2b3c4d)"]
+    assert differences["added"] == []
+    assert differences["changed"] == {}
@@ -0,0 +1,117 @@
+import http.server
+import threading
+
+import pytest
+import requests
+
+from terraform_cloud_deployer.terraform_cloud.client import Client
+from terraform_cloud_deployer.terraform_cloud.transfer import ResumableDownload
+
+__author__ = "Afraz Ahmadzadeh"
+__copyright__ = "Afraz Ahmadzadeh"
+__license__ = "MIT"
+
+BODY = bytes(range(256)) * 400
+
+
+class DownloadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves BODY, honouring Range headers unless told otherwise. The first
+    [drop_after] requests are cut off after half the bytes they promised
+    """
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        start = 0
+        if self.headers.get("Range") and self.server.honour_range:
+            start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+            if start >= len(BODY):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(BODY) - 1}/{len(BODY)}")
+        else:
+            self.send_response(200)
+
+        body = BODY[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(self.server.ranges) <= self.server.drop_after:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *arguments):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv("TFCD_CACHE_DIR", str(tmp_path))
+    this_server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DownloadHandler)
+    this_server.ranges = []
+    this_server.honour_range = True
+    this_server.drop_after = 0
+    thread = threading.Thread(target=this_server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield this_server
+    this_server.shutdown()
+    this_server.server_close()
+
+
+def download(server, **kwargs):
+    url = f"http://127.0.0.1:{server.server_port}/archive"
+    return ResumableDownload(Client("token", url, timeout=5), url, chunk_size=1000, **kwargs)
+
+
+def test_download(server):
+    assert download(server).read() == BODY
+    assert server.ranges == [None]
+
+
+def test_resume_after_dropped_connection(server):
+    """The rest is asked for with a Range request, and nothing is repeated or lost"""
+    server.drop_after = 2
+    assert b"".join(download(server).iter_chunks()) == BODY
+    assert len(server.ranges) == 3
+    starts = [int(this_range[len("bytes="):].rstrip("-")) for this_range in server.ranges[1:]]
+    # Each resume picks up from the last whole chunk received
+    assert 0 < starts[0] < starts[1] < len(BODY)
+
+
+def test_gives_up_after_max_resumes(server):
+    server.drop_after = 10
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        download(server, max_resumes=2).read()
+    assert len(server.ranges) == 3
+
+
+def test_range_ignored(server):
+    """A 200 to a Range request sends everything again, and what we already had is skipped"""
+    server.honour_range = False
+    assert download(server, offset=1500).read() == BODY[1500:]
+    assert server.ranges == ["bytes=1500-"]
+
+
+def test_resume_with_range_ignored(server):
+    server.honour_range = False
+    server.drop_after = 1
+    assert download(server).read() == BODY
+    assert len(server.ranges) == 2 and server.ranges[1].startswith("bytes=")
+
+
+def test_already_complete(server):
+    """A 416 for a range starting at the end means there's nothing left to fetch"""
+    assert download(server, offset=len(BODY)).read() == b""
+    assert server.ranges == [f"bytes={len(BODY)}-"]
+
+
+def test_read_sizes(server):
+    downloaded = download(server)
+    pieces = [downloaded.read(777) for _ in range(len(BODY) // 777 + 2)]
+    assert b"".join(pieces) == BODY
+    assert pieces[-1] == b""